@@ -0,0 +1,113 @@
+"""Streaming audio encoders and decoders for the Assistant API."""
+
+import logging
+import subprocess
+import threading
+
+from utils import dsp
+
+
+LINEAR16 = 'LINEAR16'
+FLAC = 'FLAC'
+MP3 = 'MP3'
+OPUS_IN_OGG = 'OPUS_IN_OGG'
+AUDIO_IN_ENCODINGS = (LINEAR16, FLAC)
+AUDIO_OUT_ENCODINGS = (LINEAR16, MP3, OPUS_IN_OGG)
+
+FFMPEG_INPUT_FORMATS = {
+    MP3: 'mp3',
+    OPUS_IN_OGG: 'ogg',
+}
+DECODER_READ_SIZE = 4096
+
+
+class FlacStreamEncoder(object):
+    """Encodes 16-bit mono PCM into a FLAC stream chunk by chunk.
+
+    Args:
+      sample_rate: sample rate in hertz.
+    """
+    def __init__(self, sample_rate):
+        # Imported here so pyflac is only needed when FLAC is selected.
+        import pyflac
+        self._encoded = []
+        self._encoder = pyflac.StreamEncoder(
+            sample_rate=sample_rate,
+            write_callback=self._on_encoded,
+        )
+
+    def _on_encoded(self, buf, num_bytes, num_samples, current_frame):
+        self._encoded.append(bytes(buf))
+
+    def _take_encoded(self):
+        data = b''.join(self._encoded)
+        self._encoded = []
+        return data
+
+    def encode(self, buf):
+        """Encode a chunk of PCM.
+
+        Returns: the FLAC bytes produced so far, possibly empty since the
+        encoder works on whole blocks.
+        """
+        self._encoder.process(dsp.as_samples(buf))
+        return self._take_encoded()
+
+    def finish(self):
+        """Returns: the remaining FLAC bytes of the stream."""
+        self._encoder.finish()
+        return self._take_encoded()
+
+
+class FfmpegStreamDecoder(object):
+    """Decodes a compressed audio stream to 16-bit mono PCM as it arrives.
+
+    Compressed chunks are piped into an ffmpeg process; a reader thread
+    passes the decoded PCM to `on_pcm` in whole samples.
+
+    Args:
+      encoding: AudioOutConfig encoding of the input, MP3 or OPUS_IN_OGG.
+      sample_rate: sample rate of the decoded PCM in hertz.
+      on_pcm: callable receiving decoded PCM bytes.
+    """
+    def __init__(self, encoding, sample_rate, on_pcm):
+        if encoding not in FFMPEG_INPUT_FORMATS:
+            raise ValueError('unsupported audio out encoding: %s' % encoding)
+        self._on_pcm = on_pcm
+        self._process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error',
+             '-f', FFMPEG_INPUT_FORMATS[encoding], '-i', 'pipe:0',
+             '-f', 's16le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_loop(self):
+        remainder = b''
+        while True:
+            data = self._process.stdout.read1(DECODER_READ_SIZE)
+            if not data:
+                break
+            data = remainder + data
+            aligned = len(data) - len(data) % 2
+            remainder = data[aligned:]
+            if aligned:
+                self._on_pcm(data[:aligned])
+
+    def write(self, buf):
+        """Feed a chunk of the compressed stream."""
+        try:
+            self._process.stdin.write(buf)
+            self._process.stdin.flush()
+        except (BrokenPipeError, ValueError) as e:
+            logging.warning('Audio decoder is not accepting data: %s', e)
+
+    def close(self):
+        """End the stream and wait until all decoded PCM was delivered."""
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._reader.join()
+        self._process.wait()
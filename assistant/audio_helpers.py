@@ -14,9 +14,11 @@
 
 """Helper functions for audio streams."""
 
-import array
+import collections
 import logging
 import math
+import mmap
+import struct
 import time
 import threading
 import wave
@@ -24,12 +26,18 @@ import wave
 import click
 import sounddevice as sd
 
+from utils import dsp
+from . import audio_codecs
+
 
 DEFAULT_AUDIO_SAMPLE_RATE = 16000
 DEFAULT_AUDIO_SAMPLE_WIDTH = 2
 DEFAULT_AUDIO_ITER_SIZE = 3200
 DEFAULT_AUDIO_DEVICE_BLOCK_SIZE = 6400
 DEFAULT_AUDIO_DEVICE_FLUSH_SIZE = 25600
+DEFAULT_JITTER_BUFFER_MS = 150
+DEFAULT_ENDPOINT_SPEECH_THRESHOLD = 500
+DEFAULT_ENDPOINT_MIN_SPEECH_MS = 200
 
 
 def normalize_audio_buffer(buf, volume_percentage, sample_width=2):
@@ -39,6 +47,7 @@ def normalize_audio_buffer(buf, volume_percentage, sample_width=2):
     in the buffer by a scale factor of 2^(volume_percentage/100)-1.
     For example, 50% volume scales the amplitude by a factor of 0.414,
     and 75% volume scales the amplitude by a factor of 0.681.
+    Samples saturate instead of wrapping around on overflow.
     For now we only sample_width 2.
 
     Args:
@@ -49,13 +58,7 @@ def normalize_audio_buffer(buf, volume_percentage, sample_width=2):
     if sample_width != 2:
         raise Exception('unsupported sample width:', sample_width)
     scale = math.pow(2, 1.0*volume_percentage/100)-1
-    # Construct array from bytes based on sample_width, multiply by scale
-    # and convert it back to bytes
-    arr = array.array('h', buf)
-    for idx in range(0, len(arr)):
-        arr[idx] = int(arr[idx]*scale)
-    buf = arr.tostring()
-    return buf
+    return dsp.apply_gain(buf, scale)
 
 
 def align_buf(buf, sample_width):
@@ -76,8 +79,10 @@ class WaveSource(object):
       fp: file-like stream object to read from.
       sample_rate: sample rate in hertz.
       sample_width: size of a single sample in bytes.
+      speed: playback speed relative to real time, e.g. 4 to read four
+        times faster than the sample rate. None or 0 disables throttling.
     """
-    def __init__(self, fp, sample_rate, sample_width):
+    def __init__(self, fp, sample_rate, sample_width, speed=1.0):
         self._fp = fp
         try:
             self._wavep = wave.open(self._fp, 'r')
@@ -88,6 +93,7 @@ class WaveSource(object):
             self._wavep = None
         self._sample_rate = sample_rate
         self._sample_width = sample_width
+        self._speed = speed
         self._sleep_until = 0
 
     def read(self, size):
@@ -96,11 +102,7 @@ class WaveSource(object):
         Args:
           size: number of bytes to read from the stream.
         """
-        now = time.time()
-        missing_dt = self._sleep_until - now
-        if missing_dt > 0:
-            time.sleep(missing_dt)
-        self._sleep_until = time.time() + self._sleep_time(size)
+        self._throttle(size)
         data = (self._wavep.readframes(size)
                 if self._wavep
                 else self._fp.read(size))
@@ -115,10 +117,19 @@ class WaveSource(object):
             self._wavep.close()
         self._fp.close()
 
+    def _throttle(self, size):
+        if not self._speed:
+            return
+        now = time.time()
+        missing_dt = self._sleep_until - now
+        if missing_dt > 0:
+            time.sleep(missing_dt)
+        self._sleep_until = time.time() + self._sleep_time(size)
+
     def _sleep_time(self, size):
         sample_count = size / float(self._sample_width)
         sample_rate_dt = sample_count / float(self._sample_rate)
-        return sample_rate_dt
+        return sample_rate_dt / self._speed
 
     def start(self):
         pass
@@ -131,6 +142,94 @@ class WaveSource(object):
         return self._sample_rate
 
 
+class MappedWaveSource(WaveSource):
+    """Audio source that serves a WAV file from a memory-mapped buffer.
+
+    Reads return zero-copy memoryview slices of the mapping instead of
+    going through the `wave` module, which makes replaying large
+    recordings cheap. Files without a RIFF header are served as raw PCM.
+    Throttling and end-of-file padding behave like WaveSource.
+
+    Args:
+      fp: file object with a fileno() to map.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      speed: playback speed relative to real time. None or 0 disables
+        throttling.
+    """
+    def __init__(self, fp, sample_rate, sample_width, speed=1.0):
+        self._fp = fp
+        self._wavep = None
+        self._sample_rate = sample_rate
+        self._sample_width = sample_width
+        self._speed = speed
+        self._sleep_until = 0
+        self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        start, end = _find_wave_data(self._buffer)
+        self._data = self._buffer[start:end]
+        self._position = 0
+        self._silence = b''
+
+    def read(self, size):
+        """Read a view of the next bytes and block until sample rate is achieved.
+
+        Args:
+          size: number of bytes to read from the stream.
+        """
+        self._throttle(size)
+        data = self._data[self._position:self._position + size]
+        self._position += len(data)
+        #  When reach end of audio stream, pad remainder with silence (zeros).
+        if not len(data):
+            if len(self._silence) != size:
+                self._silence = b'\x00' * size
+            return self._silence
+        return data
+
+    @property
+    def size(self):
+        """Size in bytes of the audio data."""
+        return len(self._data)
+
+    def rewind(self):
+        """Restart reading from the beginning of the audio data."""
+        self._position = 0
+        self._sleep_until = 0
+
+    def close(self):
+        """Release the mapping and close the underlying file."""
+        self._data.release()
+        self._buffer.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Slices handed out by read() are still alive; the mapping is
+            # unmapped once they are garbage collected.
+            pass
+        self._fp.close()
+
+
+def _find_wave_data(buf):
+    """Returns the (start, end) offsets of the audio data in a WAV buffer.
+
+    Buffers that are not RIFF/WAVE files are treated as raw audio.
+    """
+    if len(buf) < 12 or buf[0:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        logging.warning('not a WAV file, falling back to RAW format')
+        return 0, len(buf)
+    offset = 12
+    while offset + 8 <= len(buf):
+        chunk_id = bytes(buf[offset:offset + 4])
+        chunk_size = struct.unpack_from('<I', buf, offset + 4)[0]
+        if chunk_id == b'data':
+            start = offset + 8
+            return start, min(start + chunk_size, len(buf))
+        # Chunks are padded to an even size.
+        offset += 8 + chunk_size + (chunk_size & 1)
+    raise ValueError('WAV file has no data chunk')
+
+
 class WaveSink(object):
     """Audio sink that writes audio data to a WAV file.
 
@@ -179,13 +278,17 @@ class SoundDeviceStream(object):
       sample_width: size of a single sample in bytes.
       block_size: size in bytes of each read and write operation.
       flush_size: size in bytes of silence data written during flush operation.
+      output_only: only open the output side of the device, for when input
+        is captured elsewhere (e.g. by a CaptureHub).
     """
-    def __init__(self, sample_rate, sample_width, block_size, flush_size):
+    def __init__(self, sample_rate, sample_width, block_size, flush_size,
+                 output_only=False):
         if sample_width == 2:
             audio_format = 'int16'
         else:
             raise Exception('unsupported sample width:', sample_width)
-        self._audio_stream = sd.RawStream(
+        stream_class = sd.RawOutputStream if output_only else sd.RawStream
+        self._audio_stream = stream_class(
             samplerate=sample_rate, dtype=audio_format, channels=1,
             blocksize=int(block_size/2),  # blocksize is in number of frames.
         )
@@ -235,6 +338,209 @@ class SoundDeviceStream(object):
         return self._sample_rate
 
 
+class BufferedPlaybackSink(object):
+    """Audio sink that plays back through another sink from its own thread.
+
+    Writes are queued and return immediately, so a slow audio device does
+    not back-pressure the caller. Output only begins once the jitter buffer
+    holds `jitter_buffer_ms` of audio, or when flushed, which absorbs uneven
+    arrival of network audio chunks. If the buffer runs dry in the middle
+    of a playback it is refilled before output resumes.
+
+    Args:
+      sink: audio sink written to by the writer thread.
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      jitter_buffer_ms: amount of audio buffered before output starts.
+    """
+    def __init__(self, sink, sample_rate, sample_width,
+                 jitter_buffer_ms=DEFAULT_JITTER_BUFFER_MS):
+        self._sink = sink
+        self._bytes_per_ms = sample_rate * sample_width / 1000.0
+        self._jitter_buffer_size = int(jitter_buffer_ms * self._bytes_per_ms)
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._condition = threading.Condition()
+        self._prefilling = True
+        self._draining = False
+        self._writing = False
+        self._starved = False
+        self._closed = False
+        self._reset_metrics()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _reset_metrics(self):
+        self._underflows = 0
+        self._max_buffered = 0
+        self._start_time = time.time()
+        self._first_write_time = None
+
+    def write(self, buf):
+        """Queue bytes for playback."""
+        with self._condition:
+            if self._starved:
+                self._underflows += 1
+                self._starved = False
+            self._chunks.append(buf)
+            self._buffered += len(buf)
+            self._max_buffered = max(self._max_buffered, self._buffered)
+            self._condition.notify_all()
+        return len(buf)
+
+    def _ready_to_write(self):
+        if not self._chunks:
+            return False
+        if self._prefilling:
+            if not self._draining and (
+                    self._buffered < self._jitter_buffer_size):
+                return False
+            self._prefilling = False
+        return True
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._ready_to_write():
+                    self._condition.wait()
+                if self._closed:
+                    return
+                buf = self._chunks.popleft()
+                self._buffered -= len(buf)
+                self._writing = True
+                if self._first_write_time is None:
+                    self._first_write_time = time.time()
+            try:
+                self._sink.write(buf)
+            except Exception as e:
+                logging.warning('BufferedPlaybackSink write failed: %s', e)
+            with self._condition:
+                self._writing = False
+                if not self._chunks and not self._draining:
+                    # Ran dry: rebuffer before resuming output.
+                    self._starved = True
+                    self._prefilling = True
+                self._condition.notify_all()
+
+    def flush(self):
+        """Play back everything queued, then flush the underlying sink."""
+        with self._condition:
+            self._draining = True
+            self._condition.notify_all()
+            while self._chunks or self._writing:
+                self._condition.wait()
+        self._sink.flush()
+
+    def start(self):
+        """Start the underlying sink and reset the playback metrics."""
+        with self._condition:
+            self._prefilling = True
+            self._draining = False
+            self._starved = False
+            self._reset_metrics()
+        self._sink.start()
+
+    def stop(self):
+        """Stop the underlying sink, dropping audio that was not played."""
+        with self._condition:
+            self._chunks.clear()
+            self._buffered = 0
+            # Never stop the device under a write in flight.
+            while self._writing:
+                self._condition.wait()
+        metrics = self.metrics()
+        if metrics['first_audio_ms'] is not None:
+            logging.info('Playback: first audio after %d ms, %d underflows, '
+                         'max buffer depth %d ms',
+                         metrics['first_audio_ms'], metrics['underflows'],
+                         metrics['max_depth_ms'])
+        self._sink.stop()
+
+    def close(self):
+        """Stop the writer thread and close the underlying sink."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        self._sink.close()
+
+    def metrics(self):
+        """Returns playback metrics since the last start().
+
+        - underflows: times the buffer ran dry before more audio arrived.
+        - depth_ms: audio currently buffered.
+        - max_depth_ms: largest amount of audio buffered.
+        - first_audio_ms: time from start() to the first device write, or
+          None if nothing was played yet.
+        """
+        with self._condition:
+            first_audio_ms = None
+            if self._first_write_time is not None:
+                first_audio_ms = (
+                    self._first_write_time - self._start_time) * 1000
+            return {
+                'underflows': self._underflows,
+                'depth_ms': self._buffered / self._bytes_per_ms,
+                'max_depth_ms': self._max_buffered / self._bytes_per_ms,
+                'first_audio_ms': first_audio_ms,
+            }
+
+
+class EnergyEndpointer(object):
+    """Detects the end of an utterance from the energy of recorded audio.
+
+    A chunk counts as speech when its RMS amplitude exceeds both
+    `speech_threshold` and three times the running noise floor measured on
+    non-speech chunks. The utterance ends once `silence_ms` of non-speech
+    follows at least `min_speech_ms` of speech.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      sample_width: size of a single sample in bytes.
+      silence_ms: trailing silence that ends the utterance.
+      speech_threshold: minimum RMS amplitude counted as speech.
+      min_speech_ms: speech required before an end can be detected.
+    """
+    def __init__(self, sample_rate, sample_width, silence_ms,
+                 speech_threshold=DEFAULT_ENDPOINT_SPEECH_THRESHOLD,
+                 min_speech_ms=DEFAULT_ENDPOINT_MIN_SPEECH_MS):
+        self._bytes_per_ms = sample_rate * sample_width / 1000.0
+        self._silence_ms = silence_ms
+        self._speech_threshold = speech_threshold
+        self._min_speech_ms = min_speech_ms
+        self.reset()
+
+    def reset(self):
+        """Forget the previous utterance."""
+        self._noise_floor = None
+        self._speech_ms = 0
+        self._trailing_silence_ms = 0
+
+    def process(self, buf):
+        """Feed a chunk of recorded audio.
+
+        Returns: True once the end of the utterance is detected.
+        """
+        duration_ms = len(buf) / self._bytes_per_ms
+        energy = dsp.rms(buf)
+        threshold = self._speech_threshold
+        if self._noise_floor is not None:
+            threshold = max(threshold, 3 * self._noise_floor)
+        if energy >= threshold:
+            self._speech_ms += duration_ms
+            self._trailing_silence_ms = 0
+            return False
+        if self._noise_floor is None:
+            self._noise_floor = energy
+        else:
+            self._noise_floor = 0.9 * self._noise_floor + 0.1 * energy
+        if self._speech_ms < self._min_speech_ms:
+            return False
+        self._trailing_silence_ms += duration_ms
+        return self._trailing_silence_ms >= self._silence_ms
+
+
 class ConversationStream(object):
     """Audio stream that supports half-duplex conversation.
 
@@ -260,23 +566,46 @@ class ConversationStream(object):
       sink: file-like stream object to write output audio bytes to.
       iter_size: read size in bytes for each iteration.
       sample_width: size of a single sample in bytes.
+      endpointer: optional EnergyEndpointer. When it detects the end of the
+        utterance, iteration stops without waiting for stop_recording().
+      audio_out_encoding: encoding of the data passed to write(). Anything
+        but LINEAR16 is decoded to PCM during playback.
     """
-    def __init__(self, source, sink, iter_size, sample_width):
+    def __init__(self, source, sink, iter_size, sample_width,
+                 endpointer=None, audio_out_encoding=audio_codecs.LINEAR16):
         self._source = source
         self._sink = sink
         self._iter_size = iter_size
         self._sample_width = sample_width
+        self._endpointer = endpointer
+        self._audio_out_encoding = audio_out_encoding
+        self._decoder = None
         self._volume_percentage = 50
         self._stop_recording = threading.Event()
         self._source_lock = threading.RLock()
         self._recording = False
         self._playing = False
+        self._pre_roll = None
+        self._local_endpoint_time = None
 
-    def start_recording(self):
-        """Start recording from the audio source."""
+    def start_recording(self, pre_roll=None):
+        """Start recording from the audio source.
+
+        Args:
+          pre_roll: optional callable taking the started source and
+            returning audio recorded before it started, iterated ahead of
+            the live audio. It is called on the first read of the stream,
+            so it may block, e.g. until an earcon finished playing, and it
+            may move the source past the returned audio so nothing is sent
+            twice.
+        """
         self._recording = True
         self._stop_recording.clear()
+        self._local_endpoint_time = None
+        if self._endpointer is not None:
+            self._endpointer.reset()
         self._source.start()
+        self._pre_roll = pre_roll
 
     def stop_recording(self):
         """Stop recording from the audio source."""
@@ -289,9 +618,19 @@ class ConversationStream(object):
         """Start playback to the audio sink."""
         self._playing = True
         self._sink.start()
+        if self._audio_out_encoding != audio_codecs.LINEAR16:
+            self._close_decoder()
+            self._decoder = audio_codecs.FfmpegStreamDecoder(
+                self._audio_out_encoding, self.sample_rate, self._write_pcm)
+
+    def _close_decoder(self):
+        if self._decoder is not None:
+            self._decoder.close()
+            self._decoder = None
 
     def stop_playback(self):
         """Stop playback from the audio sink."""
+        self._close_decoder()
         self._sink.flush()
         self._sink.stop()
         self._playing = False
@@ -304,6 +643,11 @@ class ConversationStream(object):
     def playing(self):
         return self._playing
 
+    @property
+    def local_endpoint_time(self):
+        """Time the endpointer detected the end of the utterance, or None."""
+        return self._local_endpoint_time
+
     @property
     def volume_percentage(self):
         """The current volume setting as an integer percentage (1-100)."""
@@ -313,6 +657,11 @@ class ConversationStream(object):
     def volume_percentage(self, new_volume_percentage):
         self._volume_percentage = new_volume_percentage
 
+    @property
+    def audio_out_encoding(self):
+        """Encoding of the audio passed to write()."""
+        return self._audio_out_encoding
+
     def read(self, size):
         """Read bytes from the source (if currently recording).
         """
@@ -322,25 +671,48 @@ class ConversationStream(object):
     def write(self, buf):
         """Write bytes to the sink (if currently playing).
         """
+        if self._decoder is not None:
+            self._decoder.write(buf)
+            return len(buf)
+        return self._write_pcm(buf)
+
+    def _write_pcm(self, buf):
         buf = align_buf(buf, self._sample_width)
         buf = normalize_audio_buffer(buf, self.volume_percentage)
         return self._sink.write(buf)
 
     def close(self):
         """Close source and sink."""
+        self._close_decoder()
         self._source.close()
         self._sink.close()
 
-    def __iter__(self):
-        """Returns a generator reading data from the stream."""
+    def _iter_chunks(self):
+        pre_roll, self._pre_roll = self._pre_roll, None
+        pre_roll_data = pre_roll(self._source) if pre_roll is not None else b''
+        if pre_roll_data:
+            logging.info('Sending %d bytes of pre-roll audio.',
+                         len(pre_roll_data))
+        for offset in range(0, len(pre_roll_data), self._iter_size):
+            yield pre_roll_data[offset:offset + self._iter_size]
         while True:
             if self._stop_recording.is_set():
                 return
             yield self.read(self._iter_size)
 
+    def __iter__(self):
+        """Returns a generator reading data from the stream."""
+        for data in self._iter_chunks():
+            yield data
+            if (self._endpointer is not None and
+                    self._endpointer.process(data)):
+                self._local_endpoint_time = time.time()
+                logging.info('End of speech detected locally.')
+                return
+
     @property
     def sample_rate(self):
-        return self._source._sample_rate
+        return self._source.sample_rate
 
 
 @click.command()
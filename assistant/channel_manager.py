@@ -0,0 +1,192 @@
+"""Warm, self-healing gRPC channel to the Google Assistant API."""
+
+import datetime
+import json
+import logging
+import threading
+
+import grpc
+import google.auth.transport.grpc
+import google.auth.transport.requests
+import google.oauth2.credentials
+
+
+DEFAULT_KEEPALIVE_TIME_MS = 120 * 1000
+DEFAULT_KEEPALIVE_TIMEOUT_MS = 20 * 1000
+DEFAULT_REFRESH_MARGIN_SEC = 5 * 60
+DEFAULT_REFRESH_INTERVAL_SEC = 30 * 60
+INITIAL_BACKOFF_SEC = 1
+MAX_BACKOFF_SEC = 60
+# gRPC stores the idle timeout in an int; this keeps the channel
+# connected between conversations.
+MAX_IDLE_TIMEOUT_MS = 2 ** 31 - 1
+
+
+class GrpcChannelManager(object):
+    """Keeps an authorized gRPC channel connected in the background.
+
+    The OAuth 2.0 credentials file is read once. A background thread then
+    refreshes the access token before it expires, keeps the HTTP/2
+    connection alive with keepalive pings, and creates a new channel
+    whenever the current one shuts down or a caller reports an RPC error.
+    Failed connection attempts and token refreshes are retried with
+    exponential backoff. Conversations only need to check `is_ready`.
+
+    Args:
+      credentials_file: path to the OAuth 2.0 credentials file.
+      api_endpoint: address of the Google Assistant API service.
+      on_channel: callable receiving every newly created channel.
+      keepalive_time_ms: interval between HTTP/2 keepalive pings.
+      keepalive_timeout_ms: time to wait for a keepalive ack.
+      refresh_margin_sec: how long before expiry the token is refreshed.
+    """
+
+    def __init__(self, credentials_file, api_endpoint, on_channel,
+                 keepalive_time_ms=DEFAULT_KEEPALIVE_TIME_MS,
+                 keepalive_timeout_ms=DEFAULT_KEEPALIVE_TIMEOUT_MS,
+                 refresh_margin_sec=DEFAULT_REFRESH_MARGIN_SEC):
+        self._credentials_file = credentials_file
+        self._api_endpoint = api_endpoint
+        self._on_channel = on_channel
+        self._channel_options = [
+            ('grpc.keepalive_time_ms', keepalive_time_ms),
+            ('grpc.keepalive_timeout_ms', keepalive_timeout_ms),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+            ('grpc.client_idle_timeout_ms', MAX_IDLE_TIMEOUT_MS),
+            ('grpc.initial_reconnect_backoff_ms', INITIAL_BACKOFF_SEC * 1000),
+            ('grpc.max_reconnect_backoff_ms', MAX_BACKOFF_SEC * 1000),
+        ]
+        self._refresh_margin = datetime.timedelta(seconds=refresh_margin_sec)
+        self._credentials = None
+        self._http_request = google.auth.transport.requests.Request()
+        self._channel = None
+        self._connectivity = None
+        self._reconnect_requested = True
+        self._closed = False
+        self._backoff = INITIAL_BACKOFF_SEC
+        self._ready = threading.Event()
+        self._wake = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """Connect in the background."""
+        self._thread.start()
+
+    def close(self):
+        """Stop the background thread and close the channel."""
+        with self._wake:
+            self._closed = True
+            self._wake.notify_all()
+        self._thread.join()
+        self._close_channel()
+
+    def is_ready(self):
+        """Returns True if the channel is connected with a valid token."""
+        credentials = self._credentials
+        return (self._ready.is_set() and credentials is not None and
+                credentials.valid)
+
+    def wait_ready(self, timeout=None):
+        """Block until the channel is ready or the timeout expires."""
+        return self._ready.wait(timeout)
+
+    def reconnect(self):
+        """Replace the channel, e.g. after an RPC failed with it."""
+        with self._wake:
+            self._reconnect_requested = True
+            self._ready.clear()
+            self._wake.notify_all()
+
+    def _load_credentials(self):
+        with open(self._credentials_file, 'r') as f:
+            return google.oauth2.credentials.Credentials(token=None,
+                                                         **json.load(f))
+
+    def _connect(self):
+        try:
+            if self._credentials is None:
+                self._credentials = self._load_credentials()
+            if not self._credentials.valid:
+                self._credentials.refresh(self._http_request)
+        except Exception as e:
+            logging.error('Error loading credentials: %s', e)
+            logging.error(
+                'Run google-oauthlib-tool to initialize new OAuth 2.0 credentials.')
+            return False
+
+        try:
+            self._close_channel()
+            self._channel = google.auth.transport.grpc.secure_authorized_channel(
+                self._credentials, self._http_request, self._api_endpoint,
+                options=self._channel_options)
+            self._channel.subscribe(self._on_connectivity,
+                                    try_to_connect=True)
+            self._on_channel(self._channel)
+            logging.info('Connecting to %s', self._api_endpoint)
+        except Exception as e:
+            logging.error(
+                'Error connecting to API endpoint credentials: %s', e)
+            return False
+        return True
+
+    def _close_channel(self):
+        channel, self._channel = self._channel, None
+        self._ready.clear()
+        if channel is not None:
+            channel.unsubscribe(self._on_connectivity)
+            channel.close()
+
+    def _on_connectivity(self, connectivity):
+        with self._wake:
+            self._connectivity = connectivity
+            if connectivity == grpc.ChannelConnectivity.READY:
+                self._backoff = INITIAL_BACKOFF_SEC
+                self._ready.set()
+            else:
+                self._ready.clear()
+            if connectivity == grpc.ChannelConnectivity.SHUTDOWN:
+                self._reconnect_requested = True
+            self._wake.notify_all()
+
+    def _seconds_until_refresh(self):
+        expiry = self._credentials.expiry if self._credentials else None
+        if expiry is None:
+            return DEFAULT_REFRESH_INTERVAL_SEC
+        remaining = expiry - self._refresh_margin - datetime.datetime.utcnow()
+        return max(0, remaining.total_seconds())
+
+    def _run(self):
+        while True:
+            with self._wake:
+                if self._closed:
+                    return
+                reconnect = self._reconnect_requested
+                self._reconnect_requested = False
+            if reconnect:
+                if not self._connect():
+                    self._wait(self._backoff)
+                    self._backoff = min(self._backoff * 2, MAX_BACKOFF_SEC)
+                    with self._wake:
+                        self._reconnect_requested = True
+                continue
+            if self._connectivity == grpc.ChannelConnectivity.IDLE:
+                # Start connecting again without waiting for the next RPC.
+                grpc.channel_ready_future(self._channel)
+            wait_sec = self._seconds_until_refresh()
+            if wait_sec > 0:
+                self._wait(wait_sec)
+                continue
+            try:
+                self._credentials.refresh(self._http_request)
+                logging.info('Refreshed Assistant API access token.')
+            except Exception as e:
+                logging.warning('Error refreshing access token: %s', e)
+                self._wait(self._backoff)
+                self._backoff = min(self._backoff * 2, MAX_BACKOFF_SEC)
+
+    def _wait(self, timeout):
+        with self._wake:
+            if not self._closed and not self._reconnect_requested:
+                self._wake.wait(timeout)
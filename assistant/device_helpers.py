@@ -14,9 +14,14 @@
 
 """Helper functions for the Device Actions."""
 
+import collections
 import concurrent.futures
 import logging
 import sys
+import threading
+import time
+
+from utils import turn_trace
 
 
 key_inputs_ = 'inputs'
@@ -25,14 +30,156 @@ key_payload_ = 'payload'
 key_commands_ = 'commands'
 key_id_ = 'id'
 
+DEFAULT_DEVICE_ACTION_WORKERS = 4
+DEFAULT_DEVICE_ACTION_TIMEOUT_SEC = 30
+QUEUE_WAIT_SAMPLES = 200
+
+
+class KeyedExecutor(object):
+    """Thread pool that keeps the callables submitted for one key in order.
+
+    Callables with different keys run concurrently on up to `max_workers`
+    threads. Callables with the same key run one after the other in
+    submission order, so commands for one target, e.g. the media player,
+    never race each other.
+
+    Args:
+      max_workers: maximum number of callables running at once.
+    """
+
+    def __init__(self, max_workers=DEFAULT_DEVICE_ACTION_WORKERS):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queue_waits = collections.deque(maxlen=QUEUE_WAIT_SAMPLES)
+        self._submitted = 0
+        self._completed = 0
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedule `fn(*args, **kwargs)` after earlier work for `key`.
+
+        Returns: a concurrent.futures.Future for the result.
+        """
+        future = concurrent.futures.Future()
+        item = (future, fn, args, kwargs, time.monotonic())
+        with self._lock:
+            self._submitted += 1
+            queue = self._pending.get(key)
+            if queue is not None:
+                queue.append(item)
+                return future
+            self._pending[key] = collections.deque()
+        self._executor.submit(self._run, key, item)
+        return future
+
+    def _run(self, key, item):
+        # Work for a key is chained on one worker until its queue is empty.
+        while item is not None:
+            future, fn, args, kwargs, submitted = item
+            queue_wait = time.monotonic() - submitted
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self._lock:
+                self._queue_waits.append(queue_wait)
+                self._completed += 1
+                queue = self._pending[key]
+                if queue:
+                    item = queue.popleft()
+                else:
+                    del self._pending[key]
+                    item = None
+            logging.debug('Device action for %s waited %.0f ms in queue',
+                          key, queue_wait * 1000)
+
+    def metrics(self):
+        """Returns counters and queue-wait statistics in milliseconds."""
+        with self._lock:
+            waits = sorted(self._queue_waits)
+            metrics = {
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'busy_keys': len(self._pending),
+            }
+        for name, q in (('queue_wait_p50_ms', 0.5), ('queue_wait_p95_ms', 0.95)):
+            metrics[name] = (waits[int(round(q * (len(waits) - 1)))] * 1000
+                             if waits else 0.0)
+        metrics['queue_wait_max_ms'] = waits[-1] * 1000 if waits else 0.0
+        return metrics
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class _ExecutionTimeout(object):
+    """Future of a command execution, failed once the command ran too long.
+
+    The timer starts when the command starts running, not when it is
+    submitted, so it only bounds the command itself.
+    """
+
+    def __init__(self, command, timeout_sec):
+        self.future = concurrent.futures.Future()
+        self.future.set_running_or_notify_cancel()
+        self._command = command
+        self._timeout_sec = timeout_sec
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(timeout_sec, self.__expire)
+        self._timer.daemon = True
+
+    def start(self):
+        self._timer.start()
+
+    def __settle(self, result=None, exception=None):
+        with self._lock:
+            if self.future.done():
+                return False
+            if exception is not None:
+                self.future.set_exception(exception)
+            else:
+                self.future.set_result(result)
+            return True
+
+    def __expire(self):
+        if self.__settle(exception=concurrent.futures.TimeoutError(
+                '%s did not finish within %s s' % (
+                    self._command, self._timeout_sec))):
+            logging.warning('Device action timed out: %s', self._command)
+
+    def settle_from(self, f):
+        """Done callback of the execution future."""
+        self._timer.cancel()
+        if f.cancelled():
+            self.__settle(exception=concurrent.futures.CancelledError())
+            return
+        exception = f.exception()
+        if exception is not None:
+            self.__settle(exception=exception)
+        else:
+            self.__settle(result=f.result())
+
 
 class DeviceRequestHandler(object):
     """Asynchronous dispatcher for Device actions commands.
 
     Dispatch commands to the given device handlers.
 
+    Commands for different targets run concurrently; commands sharing an
+    ordering key run in the order they were received.
+
     Args:
       device_id: device id to match command against
+      max_workers: number of commands that may run at once.
+      timeout_sec: running time after which the future of a command fails
+        with concurrent.futures.TimeoutError. Time queued behind earlier
+        commands with the same key does not count. The command itself keeps
+        running, and later commands with the same key still wait for it.
+        None disables the timeout.
 
     Example:
       # Use as as decorator to register handler.
@@ -40,12 +187,20 @@ class DeviceRequestHandler(object):
       @device_handler.command('INTENT_NAME')
       def handler(param):
           pass
+
+      # Commands for the same light run in order.
+      @device_handler.command('TURN_ON', key=lambda light: light)
+      def turn_on(light):
+          pass
     """
 
-    def __init__(self, device_id):
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    def __init__(self, device_id, max_workers=DEFAULT_DEVICE_ACTION_WORKERS,
+                 timeout_sec=DEFAULT_DEVICE_ACTION_TIMEOUT_SEC):
+        self.executor = KeyedExecutor(max_workers=max_workers)
+        self.timeout_sec = timeout_sec
         self.device_id = device_id
         self.handlers = {}
+        self.keys = {}
 
     def __call__(self, device_request):
         """Handle incoming device request.
@@ -60,12 +215,36 @@ class DeviceRequestHandler(object):
                         fs.extend(self.submit_commands(**command))
         return fs
 
-    def command(self, intent):
-        """Register a device action handlers."""
+    def command(self, intent, key=None):
+        """Register a device action handlers.
+
+        Args:
+          intent: command name the handler is registered for.
+          key: ordering key of the command, or a callable computing it from
+            the command params. Defaults to the command name, so repeated
+            commands of one kind never overlap.
+        """
         def decorator(fn):
             self.handlers[intent] = fn
+            if key is not None:
+                self.keys[intent] = key
         return decorator
 
+    def command_key(self, command, params=None):
+        """Returns the ordering key of a command execution."""
+        key = self.keys.get(command, command)
+        if callable(key):
+            try:
+                return key(**(params or {}))
+            except Exception as e:
+                logging.warning('Could not compute key of %s: %s', command, e)
+                return command
+        return key
+
+    def metrics(self):
+        """Returns the executor counters and queue-wait statistics."""
+        return self.executor.metrics()
+
     def submit_commands(self, devices, execution):
         """Submit device command executions.
 
@@ -81,12 +260,39 @@ class DeviceRequestHandler(object):
                 logging.warning('Ignoring noop execution')
                 continue
             for command in execution:
-                f = self.executor.submit(
-                    self.dispatch_command, **command
-                )
-                fs.append(f)
+                fs.append(self.execute(**command))
         return fs
 
+    def execute(self, command, params=None):
+        """Schedule one command execution, e.g. from a local recognizer.
+
+        Returns: a concurrent.futures.Future for the execution.
+        """
+        command = dict(command=command, params=params or {})
+        turn = turn_trace.get_tracer().current_turn()
+        timeout = None
+        if self.timeout_sec:
+            timeout = _ExecutionTimeout(command['command'], self.timeout_sec)
+        f = self.executor.submit(
+            self.command_key(**command),
+            self.__dispatch_traced, turn, command, timeout
+        )
+        if timeout is None:
+            return f
+        f.add_done_callback(timeout.settle_from)
+        return timeout.future
+
+    def __dispatch_traced(self, turn, command, timeout=None):
+        if timeout is not None:
+            timeout.start()
+        if turn is not None:
+            turn.mark(turn_trace.DEVICE_COMMAND_STARTED)
+        try:
+            return self.dispatch_command(**command)
+        finally:
+            if turn is not None:
+                turn.mark(turn_trace.DEVICE_COMMAND_DONE, overwrite=True)
+
     def dispatch_command(self, command, params=None):
         """Dispatch device commands to the appropriate handler."""
         try:
@@ -14,7 +14,6 @@
 
 """Sample that implements a gRPC client for the Google Assistant API."""
 
-import concurrent.futures
 import json
 import logging
 import os
@@ -22,20 +21,22 @@ import os.path
 from .speech_request_handler import get_speech_request_handler
 import pathlib2 as pathlib
 import sys
+import threading
+import time
 import uuid
 
 import click
 import grpc
-import google.auth.transport.grpc
 import google.auth.transport.requests
-import google.oauth2.credentials
 
 from google.assistant.embedded.v1alpha2 import (
     embedded_assistant_pb2,
     embedded_assistant_pb2_grpc
 )
 from tenacity import retry, stop_after_attempt, retry_if_exception
-from . import assistant_helpers, audio_helpers
+from utils import audio_mixer, turn_trace
+from . import assistant_helpers, audio_codecs, audio_helpers, device_helpers
+from .channel_manager import GrpcChannelManager
 
 
 ASSISTANT_API_ENDPOINT = 'embeddedassistant.googleapis.com'
@@ -44,6 +45,7 @@ DIALOG_FOLLOW_ON = embedded_assistant_pb2.DialogStateOut.DIALOG_FOLLOW_ON
 CLOSE_MICROPHONE = embedded_assistant_pb2.DialogStateOut.CLOSE_MICROPHONE
 PLAYING = embedded_assistant_pb2.ScreenOutConfig.PLAYING
 DEFAULT_GRPC_DEADLINE = 60 * 3 + 5
+CHANNEL_READY_TIMEOUT_SEC = 5
 
 
 class Assistant(object):
@@ -58,14 +60,19 @@ class Assistant(object):
         Google Assistant API.
       deadline_sec: gRPC deadline in seconds for Google Assistant API call.
       device_handler: callback for device actions.
+      audio_in_encoding: encoding of the uploaded query, LINEAR16 or FLAC.
+        The response encoding is set on the conversation stream, which
+        decodes it.
     """
 
-    def __init__(self, language_code, device_model_id, device_id, conversation_stream, deadline_sec, device_handler, media_player):
+    def __init__(self, language_code, device_model_id, device_id, conversation_stream, deadline_sec, device_handler, media_player,
+                 audio_in_encoding=audio_codecs.LINEAR16):
         self.language_code = language_code
         self.device_model_id = device_model_id
         self.device_id = device_id
         self.conversation_stream = conversation_stream
         self.media_player = media_player
+        self.audio_in_encoding = audio_in_encoding
 
         # Opaque blob provided in AssistResponse that,
         # when provided in a follow-up AssistRequest,
@@ -108,9 +115,14 @@ class Assistant(object):
 
     @retry(reraise=True, stop=stop_after_attempt(3),
            retry=retry_if_exception(is_grpc_error_unavailable))
-    def assist(self):
+    def assist(self, pre_roll=None):
         """Send a voice request to the Assistant and playback the response.
 
+        Args:
+          pre_roll: optional callable taking the audio source and returning
+            audio captured since the hotword, sent before the live
+            recording, see ConversationStream.start_recording.
+
         Returns: True if conversation should continue.
         """
         if (self.assistant_client is None):
@@ -118,14 +130,19 @@ class Assistant(object):
 
         continue_conversation = False
         device_actions_futures = []
+        tracer = turn_trace.get_tracer()
+        turn = tracer.current_turn() or tracer.begin_turn()
+        turn.set(attempts=turn.get('attempts', 0) + 1)
 
-        self.media_player.mute(True)
-        self.conversation_stream.start_recording()
+        self.media_player.duck(True)
+        self.conversation_stream.start_recording(pre_roll)
+        turn.mark(turn_trace.RECORDING_STARTED)
         logging.info('Recording audio request.')
 
         def iter_log_assist_requests():
             for c in self.gen_assist_requests():
                 assistant_helpers.log_assist_request_without_audio(c)
+                turn.mark(turn_trace.FIRST_REQUEST_SENT)
                 yield c
             logging.debug('Reached end of AssistRequest iteration.')
 
@@ -135,16 +152,22 @@ class Assistant(object):
                                                  self.deadline):
             assistant_helpers.log_assist_response_without_audio(resp)
             if resp.event_type == END_OF_UTTERANCE:
+                turn.mark(turn_trace.END_OF_UTTERANCE)
                 logging.info('End of audio request detected.')
+                local_endpoint_time = self.conversation_stream.local_endpoint_time
+                if local_endpoint_time is not None:
+                    logging.info('Local endpointing was %d ms ahead of the server.',
+                                 (time.time() - local_endpoint_time) * 1000)
                 logging.info('Stopping recording.')
                 self.conversation_stream.stop_recording()
-                self.media_player.mute(False)
+                self.media_player.duck(False)
             if resp.speech_results:
                 logging.info('Transcript of user request: "%s".',
                              ' '.join(r.transcript
                                       for r in resp.speech_results))
             if len(resp.audio_out.audio_data) > 0:
                 if not self.conversation_stream.playing:
+                    turn.mark(turn_trace.FIRST_AUDIO_OUT)
                     self.conversation_stream.stop_recording()
                     self.conversation_stream.start_playback()
                     logging.info('Playing assistant response.')
@@ -172,23 +195,52 @@ class Assistant(object):
                     device_actions_futures.extend(fs)
 
         if len(device_actions_futures):
-            logging.info('Waiting for device executions to complete.')
-            concurrent.futures.wait(device_actions_futures)
+            logging.info('%d device executions continue in the background.',
+                         len(device_actions_futures))
+            self.track_device_actions(device_actions_futures, turn)
 
         logging.info('Finished playing assistant response.')
         self.conversation_stream.stop_playback()
+        turn.mark(turn_trace.PLAYBACK_FINISHED)
+        tracer.end_turn(turn, status='ok', follow_on=continue_conversation)
         return continue_conversation
 
+    def track_device_actions(self, fs, turn):
+        """Report device executions as they complete, without waiting.
+
+        The turn trace is held until the last one completes, times out
+        or fails.
+        """
+        turn.hold()
+        remaining = [len(fs)]
+        lock = threading.Lock()
+
+        def on_done(f):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            turn.mark(turn_trace.DEVICE_ACTIONS_COMPLETED)
+            logging.info('Device executions completed.')
+            device_metrics = getattr(self.device_handler, 'metrics', None)
+            if device_metrics is not None:
+                logging.info('Device action queue: %s', ', '.join(
+                    '%s=%.0f' % item for item in sorted(device_metrics().items())))
+            turn.release()
+
+        for f in fs:
+            f.add_done_callback(on_done)
+
     def gen_assist_requests(self):
         """Yields: AssistRequest messages to send to the API."""
 
         config = embedded_assistant_pb2.AssistConfig(
             audio_in_config=embedded_assistant_pb2.AudioInConfig(
-                encoding='LINEAR16',
+                encoding=self.audio_in_encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
             ),
             audio_out_config=embedded_assistant_pb2.AudioOutConfig(
-                encoding='LINEAR16',
+                encoding=self.conversation_stream.audio_out_encoding,
                 sample_rate_hertz=self.conversation_stream.sample_rate,
                 volume_percentage=self.conversation_stream.volume_percentage,
             ),
@@ -207,13 +259,28 @@ class Assistant(object):
         # The first AssistRequest must contain the AssistConfig
         # and no audio data.
         yield embedded_assistant_pb2.AssistRequest(config=config)
+        if self.audio_in_encoding == audio_codecs.FLAC:
+            encoder = audio_codecs.FlacStreamEncoder(
+                self.conversation_stream.sample_rate)
+            for data in self.conversation_stream:
+                data = encoder.encode(data)
+                if data:
+                    yield embedded_assistant_pb2.AssistRequest(audio_in=data)
+            data = encoder.finish()
+            if data:
+                yield embedded_assistant_pb2.AssistRequest(audio_in=data)
+            return
         for data in self.conversation_stream:
             # Subsequent requests need audio data, but not config.
-            yield embedded_assistant_pb2.AssistRequest(audio_in=data)
+            # Sources may return memoryviews; bytes() of bytes is free.
+            yield embedded_assistant_pb2.AssistRequest(audio_in=bytes(data))
 
 
 class PushToTalkInstance:
-    def __init__(self, api_endpoint, credentials_file, project_id, device_model_id, device_id, device_config, lang, verbose, audio_sample_rate, audio_sample_width, audio_iter_size, audio_block_size, audio_flush_size, grpc_deadline):
+    def __init__(self, api_endpoint, credentials_file, project_id, device_model_id, device_id, device_config, lang, verbose, audio_sample_rate, audio_sample_width, audio_iter_size, audio_block_size, audio_flush_size, grpc_deadline, audio_source=None, audio_jitter_buffer_ms=audio_helpers.DEFAULT_JITTER_BUFFER_MS, local_endpoint_silence_ms=0,
+                 audio_in_encoding=audio_codecs.LINEAR16, audio_out_encoding=audio_codecs.LINEAR16,
+                 device_action_workers=device_helpers.DEFAULT_DEVICE_ACTION_WORKERS, mixer=None,
+                 known_device_names=None):
         """Samples for the Google Assistant API.
 
         Examples:
@@ -228,34 +295,81 @@ class PushToTalkInstance:
         Run the sample with file input and output:
 
             $ python -m googlesamples.assistant -i <input file> -o <output file>
+
+        If `audio_source` is given (e.g. a CaptureHubSource), queries are
+        recorded from it and the sound device is only opened for output.
+
+        If `local_endpoint_silence_ms` is positive, the request stream is
+        closed after that much trailing silence instead of waiting for the
+        server to detect the end of the utterance.
+
+        `audio_in_encoding` and `audio_out_encoding` select compressed
+        query and response audio to save bandwidth.
+
+        `device_action_workers` device actions for different targets run
+        at once.
+
+        If `mixer` (an AudioMixer) is given, replies, spoken confirmations
+        and media are played through its channels, and media is ducked
+        instead of muted while a query is recorded.
+
+        Spoken confirmations for `known_device_names` are synthesized ahead
+        of their first use.
         """
         # Setup logging.
         logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
 
         # Configure audio source and sink.
         audio_device = None
-        audio_source = audio_device = (
-            audio_device or audio_helpers.SoundDeviceStream(
-                sample_rate=audio_sample_rate,
-                sample_width=audio_sample_width,
-                block_size=audio_block_size,
-                flush_size=audio_flush_size
+        if audio_source is None:
+            audio_source = audio_device = (
+                audio_device or audio_helpers.SoundDeviceStream(
+                    sample_rate=audio_sample_rate,
+                    sample_width=audio_sample_width,
+                    block_size=audio_block_size,
+                    flush_size=audio_flush_size
+                )
             )
+        elif audio_source.sample_rate != audio_sample_rate:
+            logging.error('Audio source rate %d does not match --audio-sample-rate %d',
+                          audio_source.sample_rate, audio_sample_rate)
+            sys.exit(-1)
+        if mixer is not None:
+            audio_sink = mixer.open_channel(
+                'assistant', priority=audio_mixer.SPEECH_PRIORITY,
+                sample_rate=audio_sample_rate)
+        else:
+            audio_sink = audio_device = (
+                audio_device or audio_helpers.SoundDeviceStream(
+                    sample_rate=audio_sample_rate,
+                    sample_width=audio_sample_width,
+                    block_size=audio_block_size,
+                    flush_size=audio_flush_size,
+                    output_only=True
+                )
+            )
+        # Decouple device output from the gRPC response stream.
+        audio_sink = audio_helpers.BufferedPlaybackSink(
+            audio_sink,
+            sample_rate=audio_sample_rate,
+            sample_width=audio_sample_width,
+            jitter_buffer_ms=audio_jitter_buffer_ms
         )
-        audio_sink = audio_device = (
-            audio_device or audio_helpers.SoundDeviceStream(
+        endpointer = None
+        if local_endpoint_silence_ms > 0:
+            endpointer = audio_helpers.EnergyEndpointer(
                 sample_rate=audio_sample_rate,
                 sample_width=audio_sample_width,
-                block_size=audio_block_size,
-                flush_size=audio_flush_size
+                silence_ms=local_endpoint_silence_ms
             )
-        )
         # Create conversation stream with the given audio source and sink.
         conversation_stream = audio_helpers.ConversationStream(
             source=audio_source,
             sink=audio_sink,
             iter_size=audio_iter_size,
             sample_width=audio_sample_width,
+            endpointer=endpointer,
+            audio_out_encoding=audio_out_encoding,
         )
 
         if not device_id or not device_model_id:
@@ -301,65 +415,85 @@ class PushToTalkInstance:
                 with open(device_config, 'w') as f:
                     json.dump(payload, f)
 
-        device_handler, media_player = get_speech_request_handler(device_id)
+        # Spoken confirmations of device actions wait until the
+        # conversation, including follow-on queries, is over.
+        self._conversation_idle = threading.Condition()
+        self._in_conversation = False
+        device_handler, media_player, self.tts_helper = get_speech_request_handler(
+            device_id, max_workers=device_action_workers,
+            speech_gate=self.wait_idle, mixer=mixer,
+            known_device_names=known_device_names)
 
         self.assistant = Assistant(lang, device_model_id, device_id,
-                                   conversation_stream, grpc_deadline, device_handler, media_player)
+                                   conversation_stream, grpc_deadline, device_handler, media_player,
+                                   audio_in_encoding=audio_in_encoding)
 
-        # OAuth 2.0 credentials file
-        self.credentials_file = credentials_file
-        # Authorized gRPC channel
-        self.grpc_channel = None
+        # Authorized gRPC channel, kept connected in the background.
         self.api_endpoint = api_endpoint
-        self.__connect_to_grpc_channel()
+        self.channel_manager = GrpcChannelManager(
+            credentials_file, api_endpoint,
+            on_channel=self.assistant.set_assistant_channel)
+        self.channel_manager.start()
 
-    def __is_grpc_channel_ready(self):
-        if (self.grpc_channel is None):
-            return False
-        try:
-            grpc.channel_ready_future(self.grpc_channel).result(timeout=5)
-            return True
-        except:
-            return False
+    @property
+    def sample_rate(self):
+        return self.assistant.conversation_stream.sample_rate
 
-    def __connect_to_grpc_channel(self):
-        try:
-            with open(self.credentials_file, 'r') as f:
-                credentials = google.oauth2.credentials.Credentials(token=None,
-                                                                    **json.load(f))
-                http_request = google.auth.transport.requests.Request()
-                credentials.refresh(http_request)
-        except Exception as e:
-            logging.error('Error loading credentials: %s', e)
-            logging.error(
-                'Run google-oauthlib-tool to initialize new OAuth 2.0 credentials.')
-            return False
+    def loop(self, pre_roll=None):
+        """Runs a conversation until the Assistant closes the microphone.
+
+        Device actions may still be running when it returns.
+
+        Args:
+          pre_roll: optional callable taking the audio source and returning
+            audio captured since the hotword, sent ahead of the first query
+            only.
 
+        Returns: False if the Assistant could not be reached.
+        """
+        with self._conversation_idle:
+            self._in_conversation = True
+        # A confirmation still playing would be recorded into the query; it resumes once the conversation is over.
+        self.tts_helper.interrupt()
         try:
-            self.grpc_channel = google.auth.transport.grpc.secure_authorized_channel(
-                credentials, http_request, self.api_endpoint)
-            self.assistant.set_assistant_channel(self.grpc_channel)
-            logging.info('Connecting to %s', self.api_endpoint)
-        except Exception as e:
-            logging.error(
-                'Error connecting to API endpoint credentials: %s', e)
-            return False
-        return True
+            return self.__converse(pre_roll)
+        finally:
+            with self._conversation_idle:
+                self._in_conversation = False
+                self._conversation_idle.notify_all()
+
+    def execute_device_command(self, command, params=None):
+        """Run a device action handler directly, without the Assistant.
 
-    def loop(self):
-        if (not self.__is_grpc_channel_ready()):
-            if (not self.__connect_to_grpc_channel()):
+        Returns: a concurrent.futures.Future for the execution.
+        """
+        return self.assistant.device_handler.execute(command, params)
+
+    def wait_idle(self, timeout=None):
+        """Block until no conversation is running.
+
+        Returns: False if the timeout expired first.
+        """
+        with self._conversation_idle:
+            return self._conversation_idle.wait_for(
+                lambda: not self._in_conversation, timeout)
+
+    def __converse(self, pre_roll):
+        if (not self.channel_manager.is_ready()):
+            logging.info('Waiting for the Assistant API channel.')
+            if (not self.channel_manager.wait_ready(timeout=CHANNEL_READY_TIMEOUT_SEC)):
                 return False
 
         try:
-            continue_conversation = True
+            continue_conversation = self.assistant.assist(pre_roll)
             while continue_conversation:
                 continue_conversation = self.assistant.assist()
             return True
         except Exception as e:
+            turn_trace.get_tracer().end_turn(status='error', error=type(e).__name__)
             is_grpc_error = isinstance(e, grpc.RpcError)
             if (is_grpc_error):
-                self.grpc_channel = None
+                self.channel_manager.reconnect()
             return False
 
 
@@ -420,18 +554,47 @@ class PushToTalkInstance:
               metavar='<audio flush size>', show_default=True,
               help=('Size of silence data in bytes written '
                     'during flush operation'))
+@click.option('--audio-jitter-buffer-ms',
+              default=audio_helpers.DEFAULT_JITTER_BUFFER_MS,
+              metavar='<audio jitter buffer ms>', show_default=True,
+              help=('Milliseconds of response audio buffered before '
+                    'playback starts.'))
+@click.option('--local-endpoint-silence-ms', default=0,
+              metavar='<local endpoint silence ms>', show_default=True,
+              help=('Trailing silence in milliseconds after which the query '
+                    'is ended locally, 0 to wait for the server.'))
+@click.option('--audio-in-encoding', default=audio_codecs.LINEAR16,
+              type=click.Choice(audio_codecs.AUDIO_IN_ENCODINGS),
+              show_default=True,
+              help='Encoding of the query audio sent to the Assistant.')
+@click.option('--audio-out-encoding', default=audio_codecs.LINEAR16,
+              type=click.Choice(audio_codecs.AUDIO_OUT_ENCODINGS),
+              show_default=True,
+              help='Encoding of the response audio sent by the Assistant.')
+@click.option('--device-action-workers',
+              default=device_helpers.DEFAULT_DEVICE_ACTION_WORKERS,
+              metavar='<device action workers>', show_default=True,
+              help='Number of device actions executed concurrently.')
 @click.option('--grpc-deadline', default=DEFAULT_GRPC_DEADLINE,
               metavar='<grpc deadline>', show_default=True,
               help='gRPC deadline in seconds')
-def main(api_endpoint, credentials, project_id, device_model_id, device_id, device_config, lang, verbose, audio_sample_rate, audio_sample_width, audio_iter_size, audio_block_size, audio_flush_size, grpc_deadline):
+def main(api_endpoint, credentials, project_id, device_model_id, device_id, device_config, lang, verbose, audio_sample_rate, audio_sample_width, audio_iter_size, audio_block_size, audio_flush_size, audio_jitter_buffer_ms, local_endpoint_silence_ms, audio_in_encoding, audio_out_encoding, device_action_workers, grpc_deadline):
     instance = PushToTalkInstance(api_endpoint, credentials, project_id, device_model_id, device_id, device_config, lang,
-                                  verbose, audio_sample_rate, audio_sample_width, audio_iter_size, audio_block_size, audio_flush_size, grpc_deadline)
+                                  verbose, audio_sample_rate, audio_sample_width, audio_iter_size, audio_block_size, audio_flush_size, grpc_deadline,
+                                  audio_jitter_buffer_ms=audio_jitter_buffer_ms,
+                                  local_endpoint_silence_ms=local_endpoint_silence_ms,
+                                  audio_in_encoding=audio_in_encoding,
+                                  audio_out_encoding=audio_out_encoding,
+                                  device_action_workers=device_action_workers)
     while True:
         input("Press Enter to start issue command")
         instance.loop()
 
 
-def get_default_push_to_talk():
+def get_default_push_to_talk(audio_source=None, local_endpoint_silence_ms=0,
+                             audio_in_encoding=audio_codecs.LINEAR16, audio_out_encoding=audio_codecs.LINEAR16,
+                             device_action_workers=device_helpers.DEFAULT_DEVICE_ACTION_WORKERS, mixer=None,
+                             known_device_names=None):
     api_endpoint = ASSISTANT_API_ENDPOINT
     credentials = os.path.join(click.get_app_dir(
         'google-oauthlib-tool'), 'credentials.json')
@@ -450,7 +613,13 @@ def get_default_push_to_talk():
     return PushToTalkInstance(
         api_endpoint, credentials, project_id, device_model_id, None, device_config, lang,
         verbose, audio_sample_rate, audio_sample_width, audio_iter_size, audio_block_size,
-        audio_flush_size, grpc_deadline
+        audio_flush_size, grpc_deadline, audio_source,
+        local_endpoint_silence_ms=local_endpoint_silence_ms,
+        audio_in_encoding=audio_in_encoding,
+        audio_out_encoding=audio_out_encoding,
+        device_action_workers=device_action_workers,
+        mixer=mixer,
+        known_device_names=known_device_names
     )
 
 
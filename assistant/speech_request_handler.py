@@ -1,77 +1,82 @@
+import threading
+
 from . import device_helpers
 from media.mediaplayer import VlcPlayer
 from media.youtube_search_engine import youtube_search, youtube_stream_link
+from home_control import home_control_service
 from home_control.home_control_service import issue_command, get_status
+from utils import audio_mixer
 from utils.text_to_speech import TextToSpeechHelper
 
 
-def get_speech_request_handler(device_id):
-    media_player = VlcPlayer()
-    tts_helper = TextToSpeechHelper('service_account.json')
-    device_handler = device_helpers.DeviceRequestHandler(device_id)
+MEDIA_PLAYER_KEY = 'media_player'
 
-    @device_handler.command('action.devices.commands.mediaStop')
-    def stopMedia():
-        print('Stop playing...')
-        media_player.stop()
+TURN_ON_PHRASE = 'Okay, turning on %s'
+TURN_OFF_PHRASE = 'Okay, turning off %s'
+IS_ON_PHRASE = '%s is turned on'
+IS_NOT_ON_PHRASE = '%s is not turned on'
+UNKNOWN_IS_ON_PHRASE = 'Sorry, I don\'t know if %s is turned on'
+FAILED_PHRASE = 'Sorry, I could not do that'
+DEVICE_PHRASES = (TURN_ON_PHRASE, TURN_OFF_PHRASE, IS_ON_PHRASE, IS_NOT_ON_PHRASE, UNKNOWN_IS_ON_PHRASE)
 
-    @device_handler.command('action.devices.commands.mediaNext')
-    def nextMedia():
-        print('To next media...')
-        media_player.next()
 
-    @device_handler.command('action.devices.commands.mediaPrevious')
-    def previousMedia():
-        print('To previous media...')
-        media_player.previous()
+def confirmation_phrases(device_names):
+    """Returns every spoken confirmation for the given device display names."""
+    phrases = [FAILED_PHRASE]
+    for device_name in device_names:
+        phrases.extend(phrase % device_name for phrase in DEVICE_PHRASES)
+    return phrases
 
-    @device_handler.command('action.devices.commands.mediaPause')
-    def pauseMedia():
-        print('Pause media...')
-        media_player.pause()
 
-    @device_handler.command('action.devices.commands.mediaResume')
-    def resumeMedia():
-        print('Resume media...')
-        media_player.play()
+def home_device_key(device_name, **params):
+    return 'home:%s' % device_name.strip().lower()
 
-    @device_handler.command('action.devices.commands.mute')
-    def mute(mute):
-        print('Set mute to %s...', str(mute))
-        media_player.mute(mute)
 
-    @device_handler.command('action.devices.commands.setVolume')
-    def setVolume(volumeLevel):
-        print('Set volume level:', volumeLevel)
-        media_player.set_volume(volumeLevel)
+def register_home_control_commands(device_handler, tts_helper):
+    """Register the home control commands, speaking their confirmations through `tts_helper`.
 
-    @device_handler.command('action.devices.commands.volumeRelative')
-    def setVolumeRelative(relativeSteps):
-        print('Set volume level relative:', relativeSteps)
-        current_level = media_player.get_volume()
-        media_player.set_volume(current_level + relativeSteps)
+    The likely confirmations are synthesized, or fetched from the cache, while the home control request is in
+    flight, and the one matching the result is played as soon as it arrives.
+    """
+    # Display names returned for spoken device names, the best guess for the next confirmation.
+    display_names = dict()
+
+    def display_name(device_name):
+        return display_names.get(device_name.strip().lower(), device_name)
+
+    def prepare(*texts):
+        return {text: tts_helper.prepare(text) for text in texts}
+
+    def confirm(prepared, text, device_name=None, target_device=None):
+        if (target_device is not None):
+            display_names[device_name.strip().lower()] = target_device['displayName']
+        tts_helper.play(prepared.get(text) or tts_helper.prepare(text))
 
-    @device_handler.command('com.homepi.homeControl.commands.TurnOn')
+    @device_handler.command('com.homepi.homeControl.commands.TurnOn', key=home_device_key)
     def turnOn(device_name):
         print('turnOn(%s)' % (device_name))
+        prepared = prepare(TURN_ON_PHRASE % display_name(device_name), FAILED_PHRASE)
         target = issue_command(device_name, 'turnOn')
         if (target is not None):
-            tts_helper.speak('Okay, turning on %s' % target['displayName'])
+            confirm(prepared, TURN_ON_PHRASE % target['displayName'], device_name, target)
         else:
-            tts_helper.speak('Sorry, I could not do that')
+            confirm(prepared, FAILED_PHRASE)
 
-    @device_handler.command('com.homepi.homeControl.commands.TurnOff')
+    @device_handler.command('com.homepi.homeControl.commands.TurnOff', key=home_device_key)
     def turnOff(device_name):
         print('turnOff(%s)' % (device_name))
+        prepared = prepare(TURN_OFF_PHRASE % display_name(device_name), FAILED_PHRASE)
         target = issue_command(device_name, 'turnOff')
         if (target is not None):
-            tts_helper.speak('Okay, turning off %s' % target['displayName'])
+            confirm(prepared, TURN_OFF_PHRASE % target['displayName'], device_name, target)
         else:
-            tts_helper.speak('Sorry, I could not do that')
+            confirm(prepared, FAILED_PHRASE)
 
-    @device_handler.command('com.homepi.homeControl.commands.RequestIsOn')
+    @device_handler.command('com.homepi.homeControl.commands.RequestIsOn', key=home_device_key)
     def isOn(device_name):
         print('isOn(%s)' % (device_name))
+        name = display_name(device_name)
+        prepared = prepare(IS_ON_PHRASE % name, IS_NOT_ON_PHRASE % name, UNKNOWN_IS_ON_PHRASE % name, FAILED_PHRASE)
         result = get_status(device_name, ['isOn'])
         if (result is not None):
             target_device, field_values = result
@@ -79,16 +84,75 @@ def get_speech_request_handler(device_id):
             isOn = field_values[0]
             print(isOn)
             if (isOn is None):
-                tts_helper.speak(
-                    'Sorry, I don\'t know if %s is turned on' % target_device_name)
+                confirm(prepared, UNKNOWN_IS_ON_PHRASE % target_device_name, device_name, target_device)
             elif (isOn == 'true'):
-                tts_helper.speak('%s is turned on' % target_device_name)
+                confirm(prepared, IS_ON_PHRASE % target_device_name, device_name, target_device)
             else:
-                tts_helper.speak('%s is not turned on' % target_device_name)
+                confirm(prepared, IS_NOT_ON_PHRASE % target_device_name, device_name, target_device)
         else:
-            tts_helper.speak('Sorry, I could not do that')
+            confirm(prepared, FAILED_PHRASE)
+
+
+def get_speech_request_handler(device_id, max_workers=device_helpers.DEFAULT_DEVICE_ACTION_WORKERS, speech_gate=None,
+                               mixer=None, known_device_names=None):
+    media_channel = tts_channel = None
+    if (mixer is not None):
+        media_channel = mixer.open_channel('media', priority=audio_mixer.MEDIA_PRIORITY)
+        tts_channel = mixer.open_channel('tts', priority=audio_mixer.SPEECH_PRIORITY)
+    media_player = VlcPlayer(mixer_channel=media_channel)
+    tts_helper = TextToSpeechHelper('service_account.json', speech_gate=speech_gate, output=tts_channel)
+    if (known_device_names):
+        # Confirmations of the known devices are synthesized in the background, so startup is not delayed.
+        threading.Thread(target=tts_helper.prewarm, args=(confirmation_phrases(known_device_names),),
+                         daemon=True).start()
+    device_handler = device_helpers.DeviceRequestHandler(
+        device_id, max_workers=max_workers)
+    home_control_service.configure(pool_size=max_workers)
+
+    register_home_control_commands(device_handler, tts_helper)
+
+    @device_handler.command('action.devices.commands.mediaStop', key=MEDIA_PLAYER_KEY)
+    def stopMedia():
+        print('Stop playing...')
+        media_player.stop()
+
+    @device_handler.command('action.devices.commands.mediaNext', key=MEDIA_PLAYER_KEY)
+    def nextMedia():
+        print('To next media...')
+        media_player.next()
+
+    @device_handler.command('action.devices.commands.mediaPrevious', key=MEDIA_PLAYER_KEY)
+    def previousMedia():
+        print('To previous media...')
+        media_player.previous()
+
+    @device_handler.command('action.devices.commands.mediaPause', key=MEDIA_PLAYER_KEY)
+    def pauseMedia():
+        print('Pause media...')
+        media_player.pause()
+
+    @device_handler.command('action.devices.commands.mediaResume', key=MEDIA_PLAYER_KEY)
+    def resumeMedia():
+        print('Resume media...')
+        media_player.play()
+
+    @device_handler.command('action.devices.commands.mute', key=MEDIA_PLAYER_KEY)
+    def mute(mute):
+        print('Set mute to %s...', str(mute))
+        media_player.mute(mute)
+
+    @device_handler.command('action.devices.commands.setVolume', key=MEDIA_PLAYER_KEY)
+    def setVolume(volumeLevel):
+        print('Set volume level:', volumeLevel)
+        media_player.set_volume(volumeLevel)
+
+    @device_handler.command('action.devices.commands.volumeRelative', key=MEDIA_PLAYER_KEY)
+    def setVolumeRelative(relativeSteps):
+        print('Set volume level relative:', relativeSteps)
+        current_level = media_player.get_volume()
+        media_player.set_volume(current_level + relativeSteps)
 
-    @device_handler.command('com.homepi.homeControl.media.commands.Play')
+    @device_handler.command('com.homepi.homeControl.media.commands.Play', key=MEDIA_PLAYER_KEY)
     def playMedia(title):
         print('Playing %s' % title)
         if (media_player.is_playing()):
@@ -97,4 +161,4 @@ def get_speech_request_handler(device_id):
         audio_steam, video_stream = youtube_stream_link(video_url)
         media_player.play_track(audio_steam)
 
-    return device_handler, media_player
+    return device_handler, media_player, tts_helper
@@ -0,0 +1,177 @@
+"""End-to-end latency benchmark of `Assistant.assist`.
+
+Runs the real client from `assistant/pushtotalk.py` against the scripted
+`benchmarks.fake_assistant` servicer on a local port. Queries are
+replayed from a WAV file, or from a synthetic tone, with a
+MappedWaveSource. Responses go to a WaveSink. The benchmark reports:
+
+- hotword to first byte: time from calling `assist()`, which stands in
+  for the hotword detection, to the server receiving the AssistConfig.
+- end of speech to first audio: time from the server receiving the end
+  of the scripted speech to the client writing the first response audio
+  to the sink.
+- turns/s: completed Assist calls per wall-clock second.
+
+`--unavailable_rate` makes the server fail that fraction of calls with
+UNAVAILABLE, which the client retries through tenacity.
+
+    $ python -m benchmarks.assistant_latency --turns 20
+    $ python -m benchmarks.assistant_latency --turns 50 --unavailable_rate 0.2 --speed 4
+"""
+
+import argparse
+import io
+import logging
+import tempfile
+import time
+import wave
+
+import grpc
+import numpy as np
+
+from assistant.audio_helpers import ConversationStream, MappedWaveSource, WaveSink
+from assistant.pushtotalk import Assistant
+from benchmarks.fake_assistant import FakeEmbeddedAssistantServicer, TURN_DEFAULTS, load_script, serve
+
+SAMPLE_WIDTH = 2
+
+
+class _TimingSink(object):
+    """Sink wrapper recording when the first audio of a response arrives."""
+
+    def __init__(self, sink):
+        self._sink = sink
+        self.first_write_time = None
+
+    def write(self, data):
+        if self.first_write_time is None:
+            self.first_write_time = time.time()
+        return self._sink.write(data)
+
+    def start(self):
+        self.first_write_time = None
+        self._sink.start()
+
+    def stop(self):
+        self._sink.stop()
+
+    def flush(self):
+        self._sink.flush()
+
+    def close(self):
+        self._sink.close()
+
+
+class _StandInMediaPlayer(object):
+    def duck(self, duck):
+        pass
+
+
+class _RecordingDeviceHandler(object):
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, device_request):
+        self.requests.append(device_request)
+        return []
+
+
+def _synthetic_query(script, sample_rate):
+    """Returns a temporary WAV file with a tone as long as the longest query."""
+    speech_ms = max(dict(TURN_DEFAULTS, **turn)['speech_ms'] for turn in script)
+    t = np.arange(int(sample_rate * speech_ms / 1000)) / float(sample_rate)
+    samples = (5000 * np.sin(2 * np.pi * 220 * t)).astype(np.int16)
+    wav_file = tempfile.TemporaryFile()
+    writer = wave.open(wav_file, 'wb')
+    writer.setnchannels(1)
+    writer.setsampwidth(SAMPLE_WIDTH)
+    writer.setframerate(sample_rate)
+    writer.writeframes(samples.tobytes())
+    writer.close()
+    wav_file.seek(0)
+    return wav_file
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=20,
+                        help='Number of conversations to run. Follow-on queries are extra turns.')
+    parser.add_argument('--script', help='JSON file with the scripted turns, see benchmarks.fake_assistant.')
+    parser.add_argument('--input_wav', help='16-bit mono WAV file replayed as every query. '
+                                            'A synthetic tone is used if not set.')
+    parser.add_argument('--output_wav', help='WAV file receiving the response audio.')
+    parser.add_argument('--sample_rate', type=int, default=16000, help='Audio sample rate in hertz.')
+    parser.add_argument('--iter_size', type=int, default=3200,
+                        help='Size of each read during audio stream iteration in bytes.')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Query replay speed relative to real time. 0 disables throttling.')
+    parser.add_argument('--unavailable_rate', type=float, default=0.0,
+                        help='Fraction of calls failed with UNAVAILABLE by the server.')
+    parser.add_argument('--deadline', type=int, default=185, help='gRPC deadline in seconds.')
+    parser.add_argument('--verbose', action='store_true', help='Log the client conversation.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    script = load_script(args.script)
+    servicer = FakeEmbeddedAssistantServicer(script, unavailable_rate=args.unavailable_rate)
+    server, port = serve(servicer)
+    channel = grpc.insecure_channel('127.0.0.1:%d' % port)
+
+    query_file = (open(args.input_wav, 'rb') if args.input_wav
+                  else _synthetic_query(script, args.sample_rate))
+    source = MappedWaveSource(query_file, args.sample_rate, SAMPLE_WIDTH, speed=args.speed or None)
+    sink = _TimingSink(WaveSink(open(args.output_wav, 'wb') if args.output_wav else io.BytesIO(),
+                                args.sample_rate, SAMPLE_WIDTH))
+    conversation_stream = ConversationStream(
+        source=source, sink=sink, iter_size=args.iter_size, sample_width=SAMPLE_WIDTH)
+    device_handler = _RecordingDeviceHandler()
+    assistant = Assistant('en-US', 'fake-device-model', 'fake-device', conversation_stream,
+                          args.deadline, device_handler, _StandInMediaPlayer())
+    assistant.set_assistant_channel(channel)
+
+    first_byte = []
+    first_audio = []
+    completed = failed = 0
+    wall_start = time.time()
+    try:
+        for _ in range(args.turns):
+            continue_conversation = True
+            while continue_conversation:
+                source.rewind()
+                turn_start = time.time()
+                try:
+                    continue_conversation = assistant.assist()
+                except grpc.RpcError as e:
+                    logging.warning('Turn failed: %s', e.code())
+                    failed += 1
+                    break
+                completed += 1
+                call = servicer.calls[-1]
+                first_byte.append(call['config'] - turn_start)
+                if sink.first_write_time is not None:
+                    first_audio.append(sink.first_write_time - call['speech_end'])
+        wall_seconds = time.time() - wall_start
+    finally:
+        conversation_stream.close()
+        channel.close()
+        server.stop(None)
+
+    print('turns: %d completed, %d failed, %.2f turns/s' % (
+        completed, failed, completed / wall_seconds))
+    print('calls: %d, injected UNAVAILABLE: %d, device actions: %d' % (
+        len(servicer.calls), sum(call['unavailable'] for call in servicer.calls),
+        len(device_handler.requests)))
+    print('%-28s %10s %10s %10s' % ('', 'p50 ms', 'p95 ms', 'max ms'))
+    for name, values in (('hotword to first byte', first_byte),
+                         ('end of speech to first audio', first_audio)):
+        print('%-28s %10.1f %10.1f %10.1f' % (
+            name, _percentile(values, 50) * 1e3, _percentile(values, 95) * 1e3,
+            max(values) * 1e3 if values else float('nan')))
+
+
+if __name__ == '__main__':
+    main()
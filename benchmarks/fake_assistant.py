@@ -0,0 +1,215 @@
+"""Local stand-in for the Google Assistant EmbeddedAssistant gRPC service.
+
+`FakeEmbeddedAssistantServicer` answers `Assist` calls from a script
+instead of recognizing speech, so `assistant/pushtotalk.py` can be run
+and measured without reaching embeddedassistant.googleapis.com. Each
+scripted turn controls:
+
+- `speech_ms`: how much query audio is treated as speech.
+- `endpoint_delay_ms`: how much more audio is consumed before
+  END_OF_UTTERANCE is sent, emulating server endpointing.
+- `first_audio_delay_ms`: time between END_OF_UTTERANCE and the first
+  audio_out chunk.
+- `audio_out_ms`, `chunk_ms`, `chunk_interval_ms`: length of the spoken
+  response, the size of each audio_out chunk and the pause between chunks.
+- `transcript`: the speech recognition result.
+- `device_request_json`: optional device action payload.
+- `follow_on`: True to answer with DIALOG_FOLLOW_ON.
+
+Turns are served round robin. A fraction of calls can be failed with
+UNAVAILABLE to exercise the client's retry path.
+
+    $ python -m benchmarks.fake_assistant --port 50051 --script turns.json
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from concurrent import futures
+
+import grpc
+import numpy as np
+from google.assistant.embedded.v1alpha2 import (
+    embedded_assistant_pb2,
+    embedded_assistant_pb2_grpc
+)
+
+END_OF_UTTERANCE = embedded_assistant_pb2.AssistResponse.END_OF_UTTERANCE
+DIALOG_FOLLOW_ON = embedded_assistant_pb2.DialogStateOut.DIALOG_FOLLOW_ON
+CLOSE_MICROPHONE = embedded_assistant_pb2.DialogStateOut.CLOSE_MICROPHONE
+LINEAR16 = embedded_assistant_pb2.AudioOutConfig.LINEAR16
+
+TURN_DEFAULTS = {
+    'speech_ms': 1500,
+    'endpoint_delay_ms': 300,
+    'first_audio_delay_ms': 150,
+    'audio_out_ms': 1500,
+    'chunk_ms': 100,
+    'chunk_interval_ms': 20,
+    'transcript': '',
+    'device_request_json': None,
+    'follow_on': False,
+}
+
+DEFAULT_SCRIPT = [
+    {'transcript': 'what time is it'},
+    {'transcript': 'turn on the kitchen light',
+     'device_request_json': {
+         'requestId': 'fake-request',
+         'inputs': [{
+             'intent': 'action.devices.EXECUTE',
+             'payload': {'commands': [{
+                 'devices': [{'id': 'kitchen-light'}],
+                 'execution': [{
+                     'command': 'action.devices.commands.OnOff',
+                     'params': {'on': True},
+                 }],
+             }]},
+         }],
+     },
+     'audio_out_ms': 600},
+    {'transcript': 'set a timer', 'follow_on': True, 'audio_out_ms': 1000},
+    {'transcript': 'ten minutes', 'speech_ms': 800},
+]
+
+
+def load_script(path):
+    """Returns the turns of a JSON script file, or the default script."""
+    if path is None:
+        return list(DEFAULT_SCRIPT)
+    with open(path) as script_file:
+        return json.load(script_file)
+
+
+def _tone(duration_ms, sample_rate):
+    samples = int(sample_rate * duration_ms / 1000)
+    t = np.arange(samples) / float(sample_rate)
+    return (3000 * np.sin(2 * np.pi * 330 * t)).astype(np.int16).tobytes()
+
+
+class FakeEmbeddedAssistantServicer(embedded_assistant_pb2_grpc.EmbeddedAssistantServicer):
+    """Scripted EmbeddedAssistant servicer.
+
+    Every call appends a dict to `calls` with the times, from
+    `time.time()`, at which it started, received the config, received
+    the end of the scripted speech, sent END_OF_UTTERANCE and sent the
+    first audio_out chunk, and whether it was failed on purpose.
+
+    Args:
+      script: list of turn dicts, see TURN_DEFAULTS.
+      unavailable_rate: fraction of calls failed with UNAVAILABLE.
+      seed: seed for choosing the failed calls.
+    """
+
+    def __init__(self, script=None, unavailable_rate=0.0, seed=0):
+        self._script = [dict(TURN_DEFAULTS, **turn)
+                        for turn in (script or DEFAULT_SCRIPT)]
+        self._unavailable_rate = unavailable_rate
+        self._random = random.Random(seed)
+        self._next_turn = 0
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def _start_call(self):
+        with self._lock:
+            call = {'start': time.time(), 'unavailable': False}
+            self.calls.append(call)
+            if self._random.random() < self._unavailable_rate:
+                call['unavailable'] = True
+                return call, None
+            turn = self._script[self._next_turn % len(self._script)]
+            self._next_turn += 1
+            return call, turn
+
+    def Assist(self, request_iterator, context):
+        call, turn = self._start_call()
+        if turn is None:
+            context.abort(grpc.StatusCode.UNAVAILABLE,
+                          'Injected UNAVAILABLE error')
+        requests = iter(request_iterator)
+        config = next(requests).config
+        call['config'] = time.time()
+        if config.audio_out_config.encoding != LINEAR16:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          'Only LINEAR16 audio out is scripted')
+
+        bytes_per_ms = config.audio_in_config.sample_rate_hertz * 2 / 1000.0
+        speech_bytes = turn['speech_ms'] * bytes_per_ms
+        end_of_utterance_bytes = (
+            speech_bytes + turn['endpoint_delay_ms'] * bytes_per_ms)
+        received = 0
+        for request in requests:
+            received += len(request.audio_in)
+            if 'speech_end' not in call and received >= speech_bytes:
+                call['speech_end'] = time.time()
+            if received >= end_of_utterance_bytes:
+                break
+        call.setdefault('speech_end', time.time())
+        yield embedded_assistant_pb2.AssistResponse(
+            event_type=END_OF_UTTERANCE)
+        call['end_of_utterance'] = time.time()
+        yield embedded_assistant_pb2.AssistResponse(speech_results=[
+            embedded_assistant_pb2.SpeechRecognitionResult(
+                transcript=turn['transcript'], stability=1.0)])
+        # The client stops recording on END_OF_UTTERANCE.
+        for _ in requests:
+            pass
+
+        yield embedded_assistant_pb2.AssistResponse(
+            dialog_state_out=embedded_assistant_pb2.DialogStateOut(
+                supplemental_display_text=turn['transcript'],
+                conversation_state=b'fake-conversation-state',
+                microphone_mode=(DIALOG_FOLLOW_ON if turn['follow_on']
+                                 else CLOSE_MICROPHONE)))
+        if turn['device_request_json']:
+            yield embedded_assistant_pb2.AssistResponse(
+                device_action=embedded_assistant_pb2.DeviceAction(
+                    device_request_json=json.dumps(
+                        turn['device_request_json'])))
+
+        time.sleep(turn['first_audio_delay_ms'] / 1000.0)
+        sample_rate = config.audio_out_config.sample_rate_hertz
+        audio = _tone(turn['audio_out_ms'], sample_rate)
+        chunk_size = int(turn['chunk_ms'] * sample_rate / 1000) * 2
+        for index in range(int(math.ceil(len(audio) / float(chunk_size)))):
+            if index:
+                time.sleep(turn['chunk_interval_ms'] / 1000.0)
+            else:
+                call['first_audio'] = time.time()
+            yield embedded_assistant_pb2.AssistResponse(
+                audio_out=embedded_assistant_pb2.AudioOut(
+                    audio_data=audio[index * chunk_size:(index + 1) * chunk_size]))
+
+
+def serve(servicer, address='127.0.0.1:0', max_workers=4):
+    """Starts a gRPC server for `servicer`.
+
+    Returns: (server, bound port).
+    """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    embedded_assistant_pb2_grpc.add_EmbeddedAssistantServicer_to_server(
+        servicer, server)
+    port = server.add_insecure_port(address)
+    server.start()
+    return server, port
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=50051, help='Port to listen on.')
+    parser.add_argument('--script', help='JSON file with the list of scripted turns.')
+    parser.add_argument('--unavailable_rate', type=float, default=0.0,
+                        help='Fraction of calls failed with UNAVAILABLE.')
+    args = parser.parse_args()
+    servicer = FakeEmbeddedAssistantServicer(
+        load_script(args.script), unavailable_rate=args.unavailable_rate)
+    server, port = serve(servicer, '127.0.0.1:%d' % args.port)
+    print('Fake Assistant listening on 127.0.0.1:%d' % port)
+    server.wait_for_termination()
+
+
+if __name__ == '__main__':
+    main()
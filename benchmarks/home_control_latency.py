@@ -0,0 +1,198 @@
+"""Command-to-confirmation latency of the home control commands.
+
+Runs the TurnOn and RequestIsOn handlers from
+`assistant/speech_request_handler.py` against a local stand-in of the home
+control server, with a stand-in Cloud TTS client. Both answer after a
+configurable delay. The benchmark measures the time from dispatching a
+command to the first confirmation audio reaching the output, in two modes:
+
+- serial: the home control request, then the synthesis of the
+  confirmation, as the handlers used to do.
+- pipelined: the registered handlers, which synthesize the likely
+  confirmations while the request is in flight.
+
+Every command uses a new device name, so the phrase cache starts cold,
+unless `--device_names` makes the names repeat.
+
+    $ python -m benchmarks.home_control_latency --commands 20 --http_ms 250 --tts_ms 200
+
+The stand-in server can also be run on its own, for a device pointed at it
+with the HOME_CONTROL_API environment variable:
+
+    $ python -m benchmarks.home_control_latency --serve_port 8080
+"""
+
+import argparse
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from assistant import device_helpers
+from assistant.speech_request_handler import IS_ON_PHRASE, TURN_ON_PHRASE, register_home_control_commands
+from home_control import home_control_service
+from utils.text_to_speech import TextToSpeechHelper
+from utils.tts_cache import PhraseCache
+
+SAMPLE_RATE = 24000
+# Length of synthesized speech per character of text.
+SPEECH_MS_PER_CHAR = 60
+
+
+class _StandInHomeControlHandler(BaseHTTPRequestHandler):
+    """Answers the home control endpoints after `server.delay_sec`."""
+
+    def do_POST(self):
+        request_json = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.server.delay_sec)
+        device_name = request_json.get('deviceName')
+        response_json = {'success': True, 'target': {'displayName': device_name}}
+        if self.path.endswith('/get-status'):
+            response_json['fieldValues'] = ['true' for _ in request_json['fieldNames']]
+        body = json.dumps(response_json).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(delay_ms, address=('127.0.0.1', 0)):
+    """Starts the stand-in home control server in a thread; returns it and its URL."""
+    server = ThreadingHTTPServer(address, _StandInHomeControlHandler)
+    server.daemon_threads = True
+    server.delay_sec = delay_ms / 1000.0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://%s:%d' % server.server_address
+
+
+class _StandInSynthesisResponse(object):
+    def __init__(self, audio_content):
+        self.audio_content = audio_content
+
+
+class _StandInTtsClient(object):
+    """Returns silent LINEAR16 speech after a fixed synthesis delay."""
+
+    def __init__(self, delay_ms):
+        self._delay_sec = delay_ms / 1000.0
+        self.calls = 0
+
+    def synthesize_speech(self, input, voice, audio_config):
+        self.calls += 1
+        time.sleep(self._delay_sec)
+        samples = int(audio_config.sample_rate_hertz * SPEECH_MS_PER_CHAR * len(input.text) / 1000)
+        return _StandInSynthesisResponse(bytes(samples * 2))
+
+
+class _TimingOutput(object):
+    """Output channel recording when the first audio of each utterance arrives."""
+
+    sample_rate = SAMPLE_RATE
+
+    def __init__(self):
+        self.first_write = None
+        self._written = threading.Event()
+
+    def reset(self):
+        self.first_write = None
+        self._written.clear()
+
+    def write(self, buf):
+        if self.first_write is None:
+            self.first_write = time.time()
+            self._written.set()
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def wait(self, timeout):
+        return self._written.wait(timeout)
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+def _run(mode, command, device_names, tts_ms):
+    """Returns the command-to-confirmation latencies and the synthesis call count of one mode."""
+    output = _TimingOutput()
+    client = _StandInTtsClient(tts_ms)
+    tts_helper = TextToSpeechHelper(None, output=output, cache=PhraseCache(tempfile.mkdtemp()), client=client)
+    device_handler = device_helpers.DeviceRequestHandler('benchmark-device')
+    register_home_control_commands(device_handler, tts_helper)
+    latencies = []
+    try:
+        for device_name in device_names:
+            output.reset()
+            start = time.time()
+            if mode == 'pipelined':
+                device_handler.dispatch_command(command, {'device_name': device_name})
+            elif command.endswith('TurnOn'):
+                target = home_control_service.issue_command(device_name, 'turnOn')
+                tts_helper.speak(TURN_ON_PHRASE % target['displayName'])
+            else:
+                target, field_values = home_control_service.get_status(device_name, ['isOn'])
+                tts_helper.speak(IS_ON_PHRASE % target['displayName'])
+            if output.wait(30):
+                latencies.append(output.first_write - start)
+            # Let speculative synthesis settle so it does not overlap the next command.
+            time.sleep(tts_ms / 1000.0)
+    finally:
+        tts_helper.close()
+        device_handler.executor.shutdown()
+    return latencies, client.calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', type=int, default=20, help='Number of commands per mode.')
+    parser.add_argument('--device_names', type=int, default=0,
+                        help='Number of distinct device names cycled through. 0 makes every name new.')
+    parser.add_argument('--http_ms', type=float, default=250, help='Response delay of the home control server.')
+    parser.add_argument('--tts_ms', type=float, default=200, help='Delay of each synthesis call.')
+    parser.add_argument('--serve_port', type=int, help='Only run the stand-in home control server on this port.')
+    args = parser.parse_args()
+
+    if args.serve_port is not None:
+        server, url = serve(args.http_ms, ('127.0.0.1', args.serve_port))
+        print('Stand-in home control server listening on %s' % url)
+        threading.Event().wait()
+
+    server, url = serve(args.http_ms)
+    home_control_service.HOME_CONTROL_API = url
+    token_file = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+    token_file.write('benchmark-token')
+    token_file.close()
+    home_control_service.TOKEN_FILE = token_file.name
+    # Every status question goes to the server, so both modes pay the same round trip.
+    home_control_service.state_cache.set_ttl(0)
+
+    distinct = args.device_names or args.commands
+    device_names = ['device %d' % (i % distinct) for i in range(args.commands)]
+    print('%-12s %-12s %6s %10s %10s %10s' % ('command', 'mode', 'syn', 'p50 ms', 'p95 ms', 'max ms'))
+    try:
+        for command in ('com.homepi.homeControl.commands.TurnOn', 'com.homepi.homeControl.commands.RequestIsOn'):
+            for mode in ('serial', 'pipelined'):
+                latencies, calls = _run(mode, command, device_names, args.tts_ms)
+                print('%-12s %-12s %6d %10.1f %10.1f %10.1f' % (
+                    command.rsplit('.', 1)[1], mode, calls,
+                    _percentile(latencies, 50) * 1e3, _percentile(latencies, 95) * 1e3,
+                    max(latencies) * 1e3 if latencies else float('nan')))
+        for endpoint, stats in sorted(home_control_service.get_stats().items()):
+            print('%s: %d requests, %d errors, %d timeouts, p50 %.1f ms, p95 %.1f ms' % (
+                endpoint, stats['requests'], stats['errors'], stats['timeouts'],
+                stats['latency_p50_ms'], stats['latency_p95_ms']))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Benchmark of Assistant response volume normalization.
+
+Compares the former per-sample Python loop of
+`audio_helpers.normalize_audio_buffer` with the vectorized
+`dsp.apply_gain` on response chunks of realistic sizes.
+
+    $ python -m benchmarks.normalize_audio --chunk_ms 100 250 500 1000
+"""
+
+import argparse
+import array
+import math
+import os
+import timeit
+
+from utils import dsp
+
+
+def _loop_normalize(buf, scale):
+    arr = array.array('h', buf)
+    for idx in range(0, len(arr)):
+        arr[idx] = int(arr[idx]*scale)
+    return arr.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunk_ms', nargs='+', help='Chunk durations in milliseconds.',
+                        type=int, default=[100, 250, 500, 1000])
+    parser.add_argument('--sample_rate', help='Sample rate in hertz.',
+                        type=int, default=16000)
+    parser.add_argument('--volume_percentage', help='Assistant volume setting.',
+                        type=int, default=50)
+    parser.add_argument('--repeat', help='Number of timed runs per chunk size.',
+                        type=int, default=20)
+    args = parser.parse_args()
+
+    scale = math.pow(2, 1.0*args.volume_percentage/100)-1
+    print('%8s %14s %14s %9s' % ('chunk', 'python loop', 'dsp.apply_gain', 'speedup'))
+    for chunk_ms in args.chunk_ms:
+        buf = os.urandom(args.sample_rate * chunk_ms // 1000 * 2)
+        before = min(timeit.repeat(lambda: _loop_normalize(buf, scale),
+                                   number=1, repeat=args.repeat))
+        after = min(timeit.repeat(lambda: dsp.apply_gain(buf, scale),
+                                  number=1, repeat=args.repeat))
+        print('%6dms %12.3fms %12.3fms %8.1fx' % (
+            chunk_ms, before * 1e3, after * 1e3, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Benchmark of the per-frame cost of the wake-word capture path.
+
+Compares the old path, which unpacks every frame into a tuple with
+`struct.unpack_from` and lets `porcupine.process` rebuild a ctypes array
+from it, with `PorcupineFrameProcessor`, which copies the frame into a
+preallocated buffer. A stand-in Porcupine object mimics what pvporcupine
+does in Python around its native call, so neither a microphone nor the
+Porcupine library is needed. The native detection itself is not included.
+
+    $ python -m benchmarks.porcupine_frames --frames 20000
+"""
+
+import argparse
+import ctypes
+import os
+import struct
+import time
+
+from utils.frame_pipeline import PorcupineFrameProcessor
+
+
+class _StandInPorcupine(object):
+    def __init__(self, frame_length):
+        self.frame_length = frame_length
+        self._handle = object()
+
+    def _process_func(self, handle, pcm, result):
+        return 0
+
+    def process(self, pcm):
+        if len(pcm) != self.frame_length:
+            raise ValueError('Invalid frame length.')
+        self._process_func(
+            self._handle, (ctypes.c_short * len(pcm))(*pcm), None)
+        return -1
+
+
+def _measure(process, frames):
+    cpu_start = time.process_time()
+    for data in frames:
+        process(data)
+    return (time.process_time() - cpu_start) / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', help='Number of frames to process.',
+                        type=int, default=20000)
+    parser.add_argument('--frame_length', help='Samples per frame.',
+                        type=int, default=512)
+    args = parser.parse_args()
+
+    porcupine = _StandInPorcupine(args.frame_length)
+    pool = [os.urandom(args.frame_length * 2) for _ in range(64)]
+    frames = [pool[i % len(pool)] for i in range(args.frames)]
+
+    def before(data):
+        pcm = struct.unpack_from("h" * args.frame_length, data)
+        return porcupine.process(pcm)
+
+    after = PorcupineFrameProcessor(porcupine).process
+
+    before_cpu = _measure(before, frames)
+    after_cpu = _measure(after, frames)
+    print('struct.unpack_from + process: %.2f us CPU per frame' %
+          (before_cpu * 1e6))
+    print('PorcupineFrameProcessor:      %.2f us CPU per frame' %
+          (after_cpu * 1e6))
+    print('speedup:                      %.1fx' % (before_cpu / after_cpu))
+
+
+if __name__ == '__main__':
+    main()
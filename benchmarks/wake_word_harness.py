@@ -0,0 +1,278 @@
+"""Offline benchmark of the wake-word detection pipeline.
+
+Feeds WAV files, or a synthetic stream with known keyword positions,
+through the same FrameCaptureThread, FrameSubscription and
+PorcupineFrameProcessor path that PorcupineInstance uses, without a
+microphone. For every sensitivity it reports the real-time factor, CPU
+time per frame, detection latency from the end of each keyword, hits,
+misses, false alarms and the peak of Python allocations. The peak is
+measured in a second pass, so tracing allocations does not slow down the
+timed one.
+
+`--engine stand_in` replaces pvporcupine with an energy-burst detector so
+the harness runs on any Linux box; `--engine porcupine` uses the real
+library with the same keyword options as main.py.
+
+    $ python -m benchmarks.wake_word_harness --synthetic_seconds 120 --sensitivities 0.3 0.5 0.7
+    $ python -m benchmarks.wake_word_harness --engine porcupine --keywords porcupine \\
+          --wav_files takes/a.wav takes/b.wav --labels takes/labels.json
+
+The labels file maps each WAV path to the list of times, in seconds, at
+which a keyword ends.
+"""
+
+import argparse
+import json
+import math
+import time
+import tracemalloc
+import wave
+
+import numpy as np
+
+from utils.frame_pipeline import FrameCaptureThread, FrameSubscription, PorcupineFrameProcessor
+
+SAMPLE_RATE = 16000
+FRAME_LENGTH = 512
+TAIL_SECONDS = 1.0
+MATCH_WINDOW_SECONDS = 1.0
+
+
+class StandInPorcupine(object):
+    """Energy-burst detector with the interface of a Porcupine object.
+
+    A detection fires when a loud burst lasting at least `min_burst_frames`
+    ends. Higher sensitivities lower the loudness threshold.
+    """
+
+    def __init__(self, sensitivities, min_burst_frames=8):
+        self.sample_rate = SAMPLE_RATE
+        self.frame_length = FRAME_LENGTH
+        self._threshold = 4000 * (1.0 - min(sensitivities)) + 200
+        self._min_burst_frames = min_burst_frames
+        self._burst_frames = 0
+
+    def process(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        energy = np.sqrt(np.mean(np.square(samples, dtype=np.float64)))
+        if energy >= self._threshold:
+            self._burst_frames += 1
+            return -1
+        detected = self._burst_frames >= self._min_burst_frames
+        self._burst_frames = 0
+        return 0 if detected else -1
+
+    def delete(self):
+        pass
+
+
+def _create_engine(args, sensitivity):
+    sensitivities = [sensitivity] * len(args.keyword_paths or [None])
+    if args.engine == 'stand_in':
+        return StandInPorcupine(sensitivities)
+    import pvporcupine
+    return pvporcupine.create(
+        library_path=args.library_path or pvporcupine.LIBRARY_PATH,
+        model_path=args.model_path or pvporcupine.MODEL_PATH,
+        keyword_paths=args.keyword_paths,
+        sensitivities=sensitivities)
+
+
+class _PcmSource(object):
+    """16-bit mono PCM read like a capture stream, padded with silence at the end."""
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._position = 0
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def read(self, size):
+        data = self._data[self._position:self._position + size]
+        self._position += len(data)
+        if not len(data):
+            return b'\x00' * size
+        return data
+
+    def close(self):
+        self._data.release()
+
+
+class _WaveFileSource(_PcmSource):
+    """PCM of a 16 kHz 16-bit mono WAV file."""
+
+    def __init__(self, path):
+        with wave.open(path, 'rb') as wav:
+            if (wav.getnchannels(), wav.getsampwidth(), wav.getframerate()) != (1, 2, SAMPLE_RATE):
+                raise ValueError('%s is not 16 kHz 16-bit mono' % path)
+            super(_WaveFileSource, self).__init__(wav.readframes(wav.getnframes()))
+
+
+class _SyntheticSource(_PcmSource):
+    """Noise with tone bursts standing in for spoken keywords."""
+
+    def __init__(self, seconds, keyword_seconds=0.6, period_seconds=4.0, seed=0):
+        rng = np.random.RandomState(seed)
+        samples = rng.normal(0, 60, int(seconds * SAMPLE_RATE))
+        self.keyword_ends = []
+        t = np.arange(int(keyword_seconds * SAMPLE_RATE)) / float(SAMPLE_RATE)
+        burst = 8000 * np.sin(2 * np.pi * 440 * t)
+        start = period_seconds / 2
+        while start + keyword_seconds < seconds:
+            offset = int(start * SAMPLE_RATE)
+            samples[offset:offset + len(burst)] += burst
+            self.keyword_ends.append(start + keyword_seconds)
+            start += period_seconds
+        super(_SyntheticSource, self).__init__(
+            np.clip(samples, -32768, 32767).astype(np.int16).tobytes())
+
+
+def _run_pipeline(source, engine):
+    """Runs one source through the capture pipeline and engine.
+
+    Returns: (detection times in seconds, frames processed, CPU seconds,
+    wall seconds).
+    """
+    frame_size = engine.frame_length * 2
+    total_frames = int(math.ceil(source.size / float(frame_size)) +
+                       TAIL_SECONDS * engine.sample_rate / engine.frame_length)
+    subscription = FrameSubscription(total_frames)
+    read_count = [0]
+
+    def read_frame():
+        if read_count[0] >= total_frames:
+            capture_thread.stop()
+            return None, False
+        read_count[0] += 1
+        return source.read(frame_size), False
+
+    capture_thread = FrameCaptureThread(read_frame)
+    capture_thread.subscribe(subscription)
+    frame_processor = PorcupineFrameProcessor(engine)
+    detections = []
+    frames = 0
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    capture_thread.start()
+    while True:
+        pcm = subscription.read(frame_size, timeout=1)
+        if pcm is None:
+            if subscription.closed:
+                break
+            continue
+        frames += 1
+        if frame_processor.process(pcm) >= 0:
+            detections.append(frames * engine.frame_length / float(engine.sample_rate))
+    cpu_seconds = time.process_time() - cpu_start
+    wall_seconds = time.time() - wall_start
+    capture_thread.join()
+    return detections, frames, cpu_seconds, wall_seconds
+
+
+def _match(detections, keyword_ends):
+    """Pairs each keyword end with the first detection within the window.
+
+    Returns: (latencies in seconds, misses, false alarms).
+    """
+    remaining = list(detections)
+    latencies = []
+    misses = 0
+    for end in keyword_ends:
+        match = next((d for d in remaining
+                      if end - MATCH_WINDOW_SECONDS <= d <= end + MATCH_WINDOW_SECONDS), None)
+        if match is None:
+            misses += 1
+            continue
+        remaining.remove(match)
+        latencies.append(match - end)
+    return latencies, misses, len(remaining)
+
+
+def _open_sources(args):
+    if args.wav_files:
+        labels = dict()
+        if args.labels:
+            with open(args.labels) as labels_file:
+                labels = json.load(labels_file)
+        for path in args.wav_files:
+            yield _WaveFileSource(path), labels.get(path, [])
+    else:
+        source = _SyntheticSource(args.synthetic_seconds)
+        yield source, source.keyword_ends
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+def _run_sensitivity(args, sensitivity):
+    """Runs every source; returns detection latencies, misses, false alarms, frames, CPU, wall and audio seconds."""
+    latencies = []
+    misses = false_alarms = frames = 0
+    cpu_seconds = wall_seconds = audio_seconds = 0.0
+    for source, keyword_ends in _open_sources(args):
+        engine = _create_engine(args, sensitivity)
+        try:
+            detections, n, cpu, wall = _run_pipeline(source, engine)
+        finally:
+            engine.delete()
+            source.close()
+        frames += n
+        cpu_seconds += cpu
+        wall_seconds += wall
+        audio_seconds += n * engine.frame_length / float(engine.sample_rate)
+        file_latencies, file_misses, file_false_alarms = _match(
+            detections, keyword_ends)
+        latencies.extend(file_latencies)
+        misses += file_misses
+        false_alarms += file_false_alarms
+    return latencies, misses, false_alarms, frames, cpu_seconds, wall_seconds, audio_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['stand_in', 'porcupine'], default='stand_in',
+                        help='Detector to benchmark. `stand_in` needs no Porcupine library.')
+    parser.add_argument('--keywords', nargs='+',
+                        help='Default keywords for detection, as in main.py (porcupine engine only).')
+    parser.add_argument('--keyword_paths', nargs='+',
+                        help='Absolute paths to keyword model files, as in main.py (porcupine engine only).')
+    parser.add_argument('--library_path', help='Absolute path to dynamic library.')
+    parser.add_argument('--model_path', help='Absolute path to the file containing model parameters.')
+    parser.add_argument('--sensitivities', nargs='+', type=float, default=[0.5],
+                        help='Sensitivities to benchmark, each applied to every keyword.')
+    parser.add_argument('--wav_files', nargs='+',
+                        help='16 kHz 16-bit mono WAV files to replay. A synthetic stream is used if not set.')
+    parser.add_argument('--labels', help='JSON file mapping each WAV file to its keyword end times in seconds.')
+    parser.add_argument('--synthetic_seconds', type=float, default=60.0,
+                        help='Length of the synthetic stream.')
+    args = parser.parse_args()
+    if args.engine == 'porcupine' and args.keyword_paths is None:
+        if args.keywords is None:
+            raise ValueError("Either `--keywords` or `--keyword_paths` must be set.")
+        import pvporcupine
+        args.keyword_paths = [pvporcupine.KEYWORD_PATHS[x] for x in args.keywords]
+
+    print('%11s %8s %11s %12s %12s %5s %6s %6s %10s' % (
+        'sensitivity', 'RTF', 'us CPU/frm', 'lat p50 ms', 'lat p95 ms',
+        'hits', 'misses', 'false', 'py peak KB'))
+    for sensitivity in args.sensitivities:
+        latencies, misses, false_alarms, frames, cpu_seconds, wall_seconds, audio_seconds = \
+            _run_sensitivity(args, sensitivity)
+        # Tracing allocations slows every one of them down, so the peak comes from a separate pass.
+        tracemalloc.start()
+        try:
+            _run_sensitivity(args, sensitivity)
+            _, python_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        print('%11.2f %8.4f %11.1f %12.1f %12.1f %5d %6d %6d %10d' % (
+            sensitivity, wall_seconds / audio_seconds, cpu_seconds / frames * 1e6,
+            _percentile(latencies, 50) * 1e3, _percentile(latencies, 95) * 1e3,
+            len(latencies), misses, false_alarms, python_peak // 1024))
+
+
+if __name__ == '__main__':
+    main()
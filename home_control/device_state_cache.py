@@ -0,0 +1,94 @@
+import threading
+import time
+
+# Seconds a cached field value is trusted, per field name.
+DEFAULT_FIELD_TTL_SEC = 10
+# Field values known after a successful command, per command.
+COMMAND_FIELD_UPDATES = {
+    'turnOn': {'isOn': 'true'},
+    'turnOff': {'isOn': 'false'},
+}
+
+
+def device_key(device_name):
+    return device_name.strip().lower()
+
+
+class DeviceStateCache(object):
+    """Recently seen device metadata and field values, keyed by spoken device name.
+
+    Field values expire after their TTL. Commands update the cached fields they are known to change, and any
+    failed request for a device drops everything cached about it.
+
+    Args:
+      default_ttl_sec: TTL of fields without one of their own, 0 disables caching of those fields.
+      field_ttls_sec: optional dict of field name to TTL in seconds.
+    """
+
+    def __init__(self, default_ttl_sec=DEFAULT_FIELD_TTL_SEC, field_ttls_sec=None):
+        self._default_ttl_sec = default_ttl_sec
+        self._field_ttls_sec = dict(field_ttls_sec or {})
+        self._targets = dict()
+        self._fields = dict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def set_ttl(self, seconds, field_name=None):
+        """Set the TTL of one field, or the default TTL."""
+        with self._lock:
+            if (field_name is None):
+                self._default_ttl_sec = seconds
+            else:
+                self._field_ttls_sec[field_name] = seconds
+
+    def __ttl(self, field_name):
+        return self._field_ttls_sec.get(field_name, self._default_ttl_sec)
+
+    def get_status(self, device_name, field_names):
+        """Returns (target, field values) if every field is fresh, None otherwise."""
+        key = device_key(device_name)
+        now = time.monotonic()
+        with self._lock:
+            target = self._targets.get(key)
+            fields = self._fields.get(key, {})
+            values = []
+            for field_name in field_names:
+                cached = fields.get(field_name)
+                if (target is None or cached is None or now - cached[1] >= self.__ttl(field_name)):
+                    self._misses += 1
+                    return None
+                values.append(cached[0])
+            self._hits += 1
+            return target, values
+
+    def update(self, device_name, target, field_values=None):
+        """Remember the target of a device and the given {field name: value}."""
+        key = device_key(device_name)
+        now = time.monotonic()
+        with self._lock:
+            self._targets[key] = target
+            fields = self._fields.setdefault(key, dict())
+            for field_name, value in (field_values or {}).items():
+                if (value is None):
+                    fields.pop(field_name, None)
+                else:
+                    fields[field_name] = (value, now)
+
+    def command_succeeded(self, device_name, command, target):
+        """Apply the known effects of a command; fields of commands with unknown effects are dropped."""
+        field_values = COMMAND_FIELD_UPDATES.get(command)
+        if (field_values is None):
+            with self._lock:
+                self._fields.pop(device_key(device_name), None)
+        self.update(device_name, target, field_values)
+
+    def invalidate(self, device_name):
+        key = device_key(device_name)
+        with self._lock:
+            self._targets.pop(key, None)
+            self._fields.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'devices': len(self._targets)}
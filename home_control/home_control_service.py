@@ -1,11 +1,100 @@
 import requests
 import json
+import os
+import threading
+import time
+from collections import deque
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, stop_after_delay, wait_exponential, wait_random
+
+from home_control.device_state_cache import DeviceStateCache
 
 TOKEN_FILE = 'token.txt'
-HOME_CONTROL_API = 'https://1ecea3c289c9.ngrok.io'
+HOME_CONTROL_API = os.getenv('HOME_CONTROL_API', 'https://1ecea3c289c9.ngrok.io')
 
+# Bound both the handshake and the wait for a response, so a stalled relay cannot hold a device action worker.
+CONNECT_TIMEOUT_SEC = 3.05
+READ_TIMEOUT_SEC = 10
+# Kept-alive connections to the API, one per concurrent device action, see configure.
+POOL_SIZE = 4
+RETRY_ATTEMPTS = 3
+# No retry starts after this many seconds. The last attempt, up to CONNECT_TIMEOUT_SEC + READ_TIMEOUT_SEC, and the
+# backoff before it still end within the 30 s device action timeout of assistant.device_helpers.
+RETRY_DEADLINE_SEC = 12
+# Gateway errors from the relay are worth retrying for idempotent calls.
+RETRYABLE_STATUS_CODES = (502, 503, 504)
+# Responses rejecting the token; it is read from the token file again before the next request.
+UNAUTHORIZED_STATUS_CODES = (401, 403)
+LATENCY_SAMPLES = 200
 
-def __get_token__():
+
+class TransientResponseError(Exception):
+    pass
+
+
+# Answers status questions locally while the cached fields are fresh, see DeviceStateCache.
+state_cache = DeviceStateCache()
+__token = None
+# Modification time of the token file when the token was read or written, see __get_token__.
+__token_mtime = None
+__token_lock = threading.Lock()
+__token_write_lock = threading.Lock()
+__session = None
+__session_lock = threading.Lock()
+__stats = dict()
+__stats_lock = threading.Lock()
+
+
+def configure(pool_size):
+    """Set the number of kept-alive connections, e.g. to the number of concurrent device actions."""
+    global POOL_SIZE, __session
+    with __session_lock:
+        POOL_SIZE = pool_size
+        # Requests in flight finish on the old session; later ones use a new pool.
+        __session = None
+
+
+def __get_session__():
+    global __session
+    with __session_lock:
+        if (__session is None):
+            __session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            __session.mount('https://', adapter)
+            __session.mount('http://', adapter)
+        return __session
+
+
+def __record__(endpoint, elapsed, error=False, timeout=False):
+    with __stats_lock:
+        stats = __stats.get(endpoint)
+        if (stats is None):
+            stats = __stats[endpoint] = {'requests': 0, 'errors': 0, 'timeouts': 0,
+                                         'latencies': deque(maxlen=LATENCY_SAMPLES)}
+        stats['requests'] += 1
+        stats['errors'] += int(error)
+        stats['timeouts'] += int(timeout)
+        stats['latencies'].append(elapsed)
+
+
+def get_stats():
+    """Returns request, error and timeout counters and latency statistics in milliseconds per endpoint."""
+    result = dict()
+    with __stats_lock:
+        for endpoint, stats in __stats.items():
+            latencies = sorted(stats['latencies'])
+            result[endpoint] = {
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'timeouts': stats['timeouts'],
+            }
+            for name, q in (('latency_p50_ms', 0.5), ('latency_p95_ms', 0.95)):
+                result[endpoint][name] = latencies[int(round(q * (len(latencies) - 1)))] * 1000
+            result[endpoint]['latency_max_ms'] = latencies[-1] * 1000
+    return result
+
+
+def __load_token__():
     try:
         with open(TOKEN_FILE) as token_file:
             token = token_file.readline()
@@ -18,20 +107,111 @@ def __get_token__():
         return None
 
 
+def __token_file_mtime__():
+    try:
+        return os.stat(TOKEN_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def __get_token__():
+    """Returns the token, read from the token file again whenever the file changed.
+
+    Other processes, e.g. bluetooth_main.py when the speaker is registered again, write the token file.
+    """
+    global __token, __token_mtime
+    mtime = __token_file_mtime__()
+    with __token_lock:
+        if (__token is None or mtime != __token_mtime):
+            __token = __load_token__()
+            __token_mtime = mtime
+        return __token
+
+
+def __forget_token__(token):
+    """Read the token file again before the next request, unless the token changed since `token` was sent."""
+    global __token_mtime
+    with __token_lock:
+        if (token == __token):
+            __token_mtime = None
+
+
+def __persist_token__(token):
+    # Write and rename, so a power cut leaves either the old or the new token, never a partial one.
+    temp_file = '%s.%d.tmp' % (TOKEN_FILE, os.getpid())
+    with open(temp_file, 'w') as token_file:
+        token_file.write(token)
+        token_file.flush()
+        os.fsync(token_file.fileno())
+    os.replace(temp_file, TOKEN_FILE)
+
+
+def __remember_written_token__(token):
+    # Our own write is not a change made by another process.
+    global __token_mtime
+    mtime = __token_file_mtime__()
+    with __token_lock:
+        if (token == __token):
+            __token_mtime = mtime
+
+
 def set_token(token):
+    global __token, __token_mtime
+    mtime = __token_file_mtime__()
+    with __token_lock:
+        if (token == __token):
+            return
+        __token = token
+        # Keeps the new token until it is written, instead of reading the old one back.
+        __token_mtime = mtime
     try:
-        with open(TOKEN_FILE, 'w') as token_file:
-            token_file.write(token)
+        with __token_write_lock:
+            # Tokens may rotate again while a write waits; the latest one is persisted.
+            with __token_lock:
+                token = __token
+            __persist_token__(token)
+            __remember_written_token__(token)
     except Exception as e:
         print('Exception happened while writting token file: %s' % str(e))
 
 
-def __send_request__(endpoint, request_json):
+def __post__(endpoint, request_json):
+    start = time.monotonic()
+    error = True
+    timeout = False
+    try:
+        response = __get_session__().post(HOME_CONTROL_API + endpoint, json=request_json,
+                                          timeout=(CONNECT_TIMEOUT_SEC, READ_TIMEOUT_SEC))
+        if (response.status_code in RETRYABLE_STATUS_CODES):
+            raise TransientResponseError('%s returned %d' % (endpoint, response.status_code))
+        error = response.status_code != 200
+        return response
+    except requests.Timeout:
+        timeout = True
+        raise
+    finally:
+        __record__(endpoint, time.monotonic() - start, error, timeout)
+
+
+__post_with_retries__ = retry(
+    reraise=True, stop=stop_after_attempt(RETRY_ATTEMPTS) | stop_after_delay(RETRY_DEADLINE_SEC),
+    wait=wait_exponential(multiplier=0.2, max=2) + wait_random(0, 0.2),
+    retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout, TransientResponseError)))(__post__)
+
+
+def __send_request__(endpoint, request_json, idempotent=False):
+    """Post to the API with the stored token; idempotent requests are retried on transient failures."""
     token = __get_token__()
     if (token is None):
         return None
     request_json['token'] = token
-    response = requests.post(HOME_CONTROL_API + endpoint, json=request_json)
+    try:
+        response = (__post_with_retries__ if idempotent else __post__)(endpoint, request_json)
+    except (requests.RequestException, TransientResponseError) as e:
+        print('Exception happened while sending request to %s: %s' % (endpoint, str(e)))
+        return None
+    if (response.status_code in UNAUTHORIZED_STATUS_CODES):
+        __forget_token__(token)
     if (response.status_code != 200):
         return None
     try:
@@ -46,7 +226,7 @@ def __send_request__(endpoint, request_json):
 
 
 def validate_token():
-    return __send_request__('/api/home-control/validate-commander', dict()) is not None
+    return __send_request__('/api/home-control/validate-commander', dict(), idempotent=True) is not None
 
 
 def issue_command(device_name, command, params=dict()):
@@ -57,16 +237,23 @@ def issue_command(device_name, command, params=dict()):
     response_json = __send_request__(
         '/api/home-control/issue-command', request_json)
     if (response_json is None or 'success' not in response_json or not response_json['success']):
+        state_cache.invalidate(device_name)
         return None
+    state_cache.command_succeeded(device_name, command, response_json['target'])
     return response_json['target']
 
 
 def get_status(device_name, field_names):
+    cached = state_cache.get_status(device_name, field_names)
+    if (cached is not None):
+        return cached
     request_json = dict()
     request_json['deviceName'] = device_name
     request_json['fieldNames'] = field_names
     response_json = __send_request__(
-        '/api/home-control/get-status', request_json)
+        '/api/home-control/get-status', request_json, idempotent=True)
     if (response_json is None or 'success' not in response_json or not response_json['success']):
+        state_cache.invalidate(device_name)
         return None
+    state_cache.update(device_name, response_json['target'], dict(zip(field_names, response_json['fieldValues'])))
     return response_json['target'], response_json['fieldValues']
@@ -1,9 +1,15 @@
 import argparse
+import json
 import pvporcupine
+from assistant import audio_codecs, device_helpers
 from assistant.pushtotalk import get_default_push_to_talk
-from utils.porcupine_helper import PorcupineInstance
-from pydub import AudioSegment
-from pydub.playback import play
+from home_control import home_control_service
+from home_control.device_state_cache import DEFAULT_FIELD_TTL_SEC
+from utils import turn_trace
+from utils.audio_mixer import AudioMixer, EARCON_PRIORITY
+from utils.capture_hub import CaptureHub
+from utils.earcons import EarconPlayer
+from utils.porcupine_helper import PorcupineInstance, DEFAULT_CAPTURE_BUFFER_FRAMES, DEFAULT_PRE_ROLL_SECONDS
 
 
 def __parse_arguments():
@@ -36,6 +42,28 @@ def __parse_arguments():
     parser.add_argument('--audio_device_index',
                         help='Index of input audio device.', type=int, default=None)
     parser.add_argument('--show_audio_devices', action='store_true')
+    parser.add_argument('--capture_buffer_frames', help='Number of audio frames buffered between the capture thread and hotword detection.',
+                        type=int, default=DEFAULT_CAPTURE_BUFFER_FRAMES)
+    parser.add_argument('--pre_roll_seconds', help='Seconds of recent audio kept so speech right after the hotword reaches the Assistant. 0 disables it.',
+                        type=float, default=DEFAULT_PRE_ROLL_SECONDS)
+    parser.add_argument('--local_endpoint_silence_ms', help='Trailing silence in milliseconds after which a query is ended locally instead of waiting for the server. 0 disables it.',
+                        type=int, default=0)
+    parser.add_argument('--audio_in_encoding', help='Encoding of the query audio sent to the Assistant.',
+                        choices=audio_codecs.AUDIO_IN_ENCODINGS, default=audio_codecs.LINEAR16)
+    parser.add_argument('--audio_out_encoding', help='Encoding of the response audio sent by the Assistant.',
+                        choices=audio_codecs.AUDIO_OUT_ENCODINGS, default=audio_codecs.LINEAR16)
+    parser.add_argument('--device_action_workers', help='Number of device actions executed concurrently. Actions for the same target always run in order.',
+                        type=int, default=device_helpers.DEFAULT_DEVICE_ACTION_WORKERS)
+    parser.add_argument('--local_commands_file', help='JSON list of keywords handled on the device without the Assistant. Each entry has ' +
+                        'a `keyword_path`, an optional `sensitivity`, and the device action `command` and optional `params` to run, ' +
+                        'e.g. [{"keyword_path": "pause.ppn", "command": "action.devices.commands.mediaPause"}].',
+                        type=str, default=None)
+    parser.add_argument('--known_devices', help='Home device display names whose spoken confirmations are synthesized at startup.',
+                        nargs='+', type=str, default=None)
+    parser.add_argument('--device_state_ttl', help='Seconds a home device status is answered from the local cache. 0 always asks the home control API.',
+                        type=float, default=DEFAULT_FIELD_TTL_SEC)
+    parser.add_argument('--turn_trace_file', help='JSONL file receiving the timing marks of every conversation turn. Rotated when it reaches 1 MB.',
+                        type=str, default=None)
     parser.add_argument('--startup_file', help='Audio file that will be played when device is starting',
                         type=str, default='resources/startup.mp3')
     parser.add_argument('--hotword_detected_file', help='Audio file that will be played when hotword is detected and the command start recording',
@@ -51,6 +79,13 @@ def __parse_arguments():
                 "Either `--keywords` or `--keyword_paths` must be set.")
         args.keyword_paths = [pvporcupine.KEYWORD_PATHS[x]
                               for x in args.keywords]
+    args.local_commands = []
+    if (args.local_commands_file is not None):
+        with open(args.local_commands_file) as local_commands_file:
+            args.local_commands = json.load(local_commands_file)
+        for local_command in args.local_commands:
+            if ('keyword_path' not in local_command or 'command' not in local_command):
+                raise ValueError('Every local command needs a `keyword_path` and a `command`.')
     if (args.sensitivities is None):
         args.sensitivities = [0.5] * len(args.keyword_paths)
     elif (len(args.keyword_paths) != len(args.sensitivities)):
@@ -65,25 +100,52 @@ def main():
         PorcupineInstance.show_audio_devices()
         return
 
+    if (args.turn_trace_file is not None):
+        turn_trace.configure(path=args.turn_trace_file)
+    home_control_service.state_cache.set_ttl(args.device_state_ttl)
+
+    # One output device mixing replies, speech, system sounds and media.
+    mixer = AudioMixer()
+    # System sounds are decoded once and played through their own mixer channel.
+    earcon_player = EarconPlayer(output=mixer.open_channel('earcons', priority=EARCON_PRIORITY))
+    earcon_player.preload([args.startup_file, args.hotword_detected_file, args.no_internet_audio_file])
     if (args.startup_file is not None):
         try:
-            with open(args.startup_file, 'rb') as no_internet_audio:
-                response_audio = AudioSegment.from_file(
-                    no_internet_audio, format='mp3')
-                play(response_audio)
+            earcon_player.play(args.startup_file)
         except Exception as e:
             print('Problem while playing startup audio:', str(e))
 
+    # One capture device shared by hotword detection and the Assistant.
+    capture_hub = CaptureHub(device=args.audio_device_index)
+    push_to_talk = get_default_push_to_talk(
+        audio_source=capture_hub.create_source(),
+        local_endpoint_silence_ms=args.local_endpoint_silence_ms,
+        audio_in_encoding=args.audio_in_encoding,
+        audio_out_encoding=args.audio_out_encoding,
+        device_action_workers=args.device_action_workers,
+        mixer=mixer,
+        known_device_names=args.known_devices)
     porcupine_instance = PorcupineInstance(
         library_path=args.library_path,
         model_path=args.model_path,
         keyword_paths=args.keyword_paths,
         sensitivities=args.sensitivities,
         input_device_index=args.audio_device_index,
-        push_to_talk=get_default_push_to_talk(),
+        push_to_talk=push_to_talk,
         hotword_detected_file=args.hotword_detected_file,
-        no_internet_audio_file=args.no_internet_audio_file)
-    porcupine_instance.run()
+        no_internet_audio_file=args.no_internet_audio_file,
+        capture_buffer_frames=args.capture_buffer_frames,
+        pre_roll_seconds=args.pre_roll_seconds,
+        capture_hub=capture_hub,
+        local_commands=args.local_commands,
+        earcon_player=earcon_player)
+    try:
+        porcupine_instance.run()
+    finally:
+        capture_hub.close()
+        earcon_player.close()
+        push_to_talk.tts_helper.close()
+        mixer.close()
 
 
 if __name__ == '__main__':
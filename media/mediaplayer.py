@@ -1,4 +1,5 @@
 import vlc
+import ctypes
 import os
 import json
 
@@ -6,9 +7,21 @@ STATUS_FILE_PATH = '.player.json'
 
 
 class VlcPlayer():
-    def __init__(self):
+    def __init__(self, mixer_channel=None):
+        """
+        :param mixer_channel: Optional MixerChannel receiving the decoded audio, so media can be mixed with and ducked
+        under speech. VLC plays to the audio device itself otherwise.
+        """
         self._vlc_instance = vlc.Instance('--verbose 0')
         self._vlc_player = self._vlc_instance.media_player_new()
+        self._mixer_channel = mixer_channel
+        self._muted = False
+        # Kept referenced for as long as VLC may call them.
+        self._audio_play_cb = vlc.CallbackDecorators.AudioPlayCb(self._on_audio_play)
+        self._audio_pause_cb = vlc.CallbackDecorators.AudioPauseCb(self._on_audio_flush)
+        self._audio_resume_cb = vlc.CallbackDecorators.AudioResumeCb(self._on_audio_resume)
+        self._audio_flush_cb = vlc.CallbackDecorators.AudioFlushCb(self._on_audio_flush)
+        self._audio_drain_cb = vlc.CallbackDecorators.AudioDrainCb(self._on_audio_drain)
         self.track_urls = None
         self.current_track_id = None
         self.num_tracks = None
@@ -29,20 +42,38 @@ class VlcPlayer():
 
     def set_volume(self, level):
         self.volume_level = max(level, 0)
-        self._vlc_player.audio_set_volume(level)
+        if (self._mixer_channel is not None):
+            self._apply_channel_gain()
+        else:
+            self._vlc_player.audio_set_volume(level)
 
     def get_volume(self):
         return self.volume_level
 
     def mute(self, status=True):
+        if (self._mixer_channel is not None):
+            self._muted = status
+            self._apply_channel_gain()
+            return 0
         return self._vlc_player.audio_set_mute(status)
 
+    def duck(self, status=True):
+        """Lower the media volume, e.g. while a query is recorded. Without a mixer channel the media is muted."""
+        if (self._mixer_channel is not None):
+            self._mixer_channel.set_ducked(status)
+        else:
+            self.mute(status)
+
     def stop(self):
         self._vlc_player.stop()
         self._is_playing = False
+        if (self._mixer_channel is not None):
+            self._mixer_channel.clear()
 
     def pause(self):
         self._vlc_player.pause()
+        if (self._mixer_channel is not None):
+            self._mixer_channel.clear()
 
     def play(self):
         if (self._vlc_player.get_state() == vlc.State.Playing):
@@ -95,8 +126,29 @@ class VlcPlayer():
     def _end_callback(self, _):
         self.next()
 
+    def _apply_channel_gain(self):
+        self._mixer_channel.set_gain(0.0 if self._muted else self.volume_level / 100.0)
+
+    def _on_audio_play(self, opaque, samples, count, pts):
+        # Blocks while the channel buffer is full, which paces VLC at the playback rate.
+        self._mixer_channel.write(ctypes.string_at(samples, count * 2))
+
+    def _on_audio_flush(self, opaque, pts):
+        self._mixer_channel.clear()
+
+    def _on_audio_resume(self, opaque, pts):
+        pass
+
+    def _on_audio_drain(self, opaque):
+        self._mixer_channel.flush()
+
     def _play_media_url(self, media_url):
         self._vlc_player = self._vlc_instance.media_player_new()
+        if (self._mixer_channel is not None):
+            self._vlc_player.audio_set_format('S16N', self._mixer_channel.sample_rate, 1)
+            self._vlc_player.audio_set_callbacks(
+                self._audio_play_cb, self._audio_pause_cb, self._audio_resume_cb,
+                self._audio_flush_cb, self._audio_drain_cb, None)
         media = self._vlc_instance.media_new(media_url)
         self._vlc_player.set_media(media)
         self._vlc_player.play()
@@ -0,0 +1,226 @@
+import collections
+import logging
+import time
+from threading import Condition, Lock
+
+import numpy as np
+import sounddevice as sd
+
+from utils import dsp
+
+DEFAULT_MIXER_SAMPLE_RATE = 48000
+# Short blocks keep earcon start and duck ramps near 10 ms at 48 kHz.
+DEFAULT_MIXER_BLOCK_FRAMES = 480
+DEFAULT_CHANNEL_BUFFER_MS = 500
+DEFAULT_DUCK_GAIN = 0.2
+# A channel keeps lower priority channels ducked for this long after its
+# last audio, so pauses between response chunks do not pump the media.
+DUCK_RELEASE_SEC = 0.5
+
+MEDIA_PRIORITY = 0
+SPEECH_PRIORITY = 1
+EARCON_PRIORITY = 2
+
+
+class MixerChannel(object):
+    """One PCM source of an AudioMixer.
+
+    Implements the sink interface of SoundDeviceStream, so it can replace a
+    device stream wherever 16-bit mono PCM is played. Writes block while
+    more than the channel buffer is queued, which paces producers at the
+    playback rate.
+
+    Args:
+      mixer: owning AudioMixer.
+      name: channel name, for logging.
+      priority: channels with a lower priority are ducked while this one
+        is playing.
+      gain: linear gain applied to the channel.
+      sample_rate: sample rate of the written PCM; resampled to the mixer
+        rate if different, continuously across writes.
+      buffer_ms: audio queued before writes block.
+    """
+
+    def __init__(self, mixer, name, priority, gain, sample_rate, buffer_ms):
+        self._mixer = mixer
+        self.name = name
+        self.priority = priority
+        self._gain = gain
+        self._applied_gain = gain
+        self._ducked = False
+        self._sample_rate = sample_rate
+        self._resampler = None
+        if sample_rate != mixer.sample_rate:
+            self._resampler = dsp.StreamResampler(sample_rate, mixer.sample_rate)
+        self._max_buffered = int(buffer_ms * mixer.sample_rate / 1000) * 2
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._buffered = 0
+        self._last_audio = 0
+        self._closed = False
+        self._condition = Condition()
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+    @property
+    def gain(self):
+        return self._gain
+
+    def set_gain(self, gain):
+        """Set the linear gain of the channel."""
+        self._gain = gain
+
+    def set_ducked(self, ducked):
+        """Duck the channel regardless of what else is playing."""
+        self._ducked = ducked
+
+    def write(self, buf):
+        """Queue PCM for playback, blocking while the buffer is full."""
+        if self._resampler is not None:
+            buf = self._resampler.process(buf)
+        with self._condition:
+            while self._buffered >= self._max_buffered and not self._closed:
+                self._condition.wait()
+            if self._closed or not len(buf):
+                return len(buf)
+            self._chunks.append(bytes(buf))
+            self._buffered += len(buf)
+        return len(buf)
+
+    def flush(self):
+        """Block until everything queued was mixed into the output."""
+        with self._condition:
+            while self._buffered and not self._closed:
+                self._condition.wait()
+
+    def clear(self):
+        """Drop queued audio that was not played yet."""
+        with self._condition:
+            self._chunks.clear()
+            self._offset = 0
+            self._buffered = 0
+            if self._resampler is not None:
+                self._resampler.reset()
+            self._condition.notify_all()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        """Stop playing and drop the queued audio."""
+        self.clear()
+
+    def close(self):
+        """Detach the channel from the mixer, unblocking writers."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._mixer._remove_channel(self)
+
+    def _playing(self, now):
+        return self._buffered > 0 or now - self._last_audio < DUCK_RELEASE_SEC
+
+    def _pull(self, size, now):
+        """Returns up to `size` queued bytes, or None if nothing is queued."""
+        with self._condition:
+            if not self._buffered:
+                return None
+            parts = []
+            needed = size
+            while needed and self._chunks:
+                chunk = self._chunks[0]
+                part = chunk[self._offset:self._offset + needed]
+                parts.append(part)
+                needed -= len(part)
+                self._offset += len(part)
+                if self._offset == len(chunk):
+                    self._chunks.popleft()
+                    self._offset = 0
+            data = b''.join(parts)
+            self._buffered -= len(data)
+            self._last_audio = now
+            self._condition.notify_all()
+            return data
+
+
+class AudioMixer(object):
+    """Single owner of the output audio device.
+
+    The device is opened once and kept running. Its callback mixes every
+    channel, Assistant replies, TTS, earcons and media, with per-channel
+    gain. While a channel plays, channels with a lower priority are ducked
+    instead of muted, and gain changes are ramped over one block to avoid
+    clicks.
+
+    Args:
+      sample_rate: output sample rate in hertz.
+      block_frames: frames mixed per device callback.
+      duck_gain: gain applied to ducked channels.
+      device: optional output device index, the default device otherwise.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_MIXER_SAMPLE_RATE, block_frames=DEFAULT_MIXER_BLOCK_FRAMES,
+                 duck_gain=DEFAULT_DUCK_GAIN, device=None):
+        self._sample_rate = sample_rate
+        self._duck_gain = duck_gain
+        self._channels = ()
+        self._lock = Lock()
+        self._stream = sd.RawOutputStream(
+            samplerate=sample_rate, dtype='int16', channels=1,
+            blocksize=block_frames, latency='low', device=device,
+            callback=self.__mix)
+        self._stream.start()
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+    def open_channel(self, name, priority=MEDIA_PRIORITY, gain=1.0, sample_rate=None,
+                     buffer_ms=DEFAULT_CHANNEL_BUFFER_MS):
+        """Returns a new MixerChannel, see its documentation for the arguments."""
+        channel = MixerChannel(self, name, priority, gain,
+                               sample_rate or self._sample_rate, buffer_ms)
+        with self._lock:
+            self._channels = self._channels + (channel,)
+        return channel
+
+    def _remove_channel(self, channel):
+        with self._lock:
+            self._channels = tuple(c for c in self._channels if c is not channel)
+
+    def __mix(self, outdata, frames, time_info, status):
+        if status.output_underflow:
+            logging.debug('AudioMixer output underflow')
+        now = time.monotonic()
+        channels = self._channels
+        playing = [c.priority for c in channels if c._playing(now)]
+        top_priority = max(playing) if playing else None
+        mixed = np.zeros(frames, dtype=np.float32)
+        for channel in channels:
+            gain = channel.gain
+            if channel._ducked or (top_priority is not None and channel.priority < top_priority):
+                gain *= self._duck_gain
+            data = channel._pull(frames * 2, now)
+            if data is None:
+                channel._applied_gain = gain
+                continue
+            samples = dsp.as_samples(data)
+            if gain != channel._applied_gain:
+                ramp = np.linspace(channel._applied_gain, gain, len(samples), dtype=np.float32)
+                mixed[:len(samples)] += samples * ramp
+                channel._applied_gain = gain
+            else:
+                mixed[:len(samples)] += samples * np.float32(gain)
+        np.clip(mixed, dsp.INT16_MIN, dsp.INT16_MAX, out=mixed)
+        outdata[:] = mixed.astype(np.int16).tobytes()
+
+    def close(self):
+        """Close every channel and the output device."""
+        for channel in self._channels:
+            channel.close()
+        if (self._stream is not None):
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
@@ -0,0 +1,140 @@
+import sounddevice as sd
+from utils.frame_pipeline import FrameCaptureThread, FrameSubscription
+
+DEFAULT_CAPTURE_SAMPLE_RATE = 16000
+DEFAULT_CAPTURE_FRAME_LENGTH = 512
+DEFAULT_SUBSCRIPTION_FRAMES = 64
+
+
+class CaptureHub(object):
+    """Single owner of the input audio device.
+
+    The microphone is opened once, at one sample rate, and read by a
+    dedicated capture thread that fans 16-bit mono PCM frames out to every
+    subscriber: the wake-word detector, the Assistant conversation source,
+    and anything else that needs live audio. The device stays open between
+    conversations.
+
+    Args:
+      sample_rate: sample rate in hertz.
+      frame_length: number of samples per captured frame.
+      device: optional input device index, the default device otherwise.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_CAPTURE_SAMPLE_RATE, frame_length=DEFAULT_CAPTURE_FRAME_LENGTH, device=None):
+        self._sample_rate = sample_rate
+        self._frame_length = frame_length
+        self._audio_stream = sd.RawInputStream(
+            samplerate=sample_rate, dtype='int16', channels=1,
+            blocksize=frame_length, device=device)
+        self._capture_thread = FrameCaptureThread(self.__read_frame)
+        self._started = False
+
+    def __read_frame(self):
+        buf, overflowed = self._audio_stream.read(self._frame_length)
+        return bytes(buf), overflowed
+
+    def start(self):
+        """Start the input device and the capture thread."""
+        if self._started:
+            return
+        self._audio_stream.start()
+        self._capture_thread.start()
+        self._started = True
+
+    def close(self):
+        """Stop capturing and release the input device."""
+        if self._audio_stream is None:
+            return
+        self._capture_thread.stop()
+        if self._started:
+            self._capture_thread.join(timeout=1)
+        self._audio_stream.close()
+        self._audio_stream = None
+
+    def subscribe(self, subscriber=None, capacity=DEFAULT_SUBSCRIPTION_FRAMES):
+        """Start delivering captured frames to a subscriber.
+
+        Args:
+          subscriber: object implementing `put`, `record_overflow` and
+            `close`. A new FrameSubscription is created if omitted.
+          capacity: buffer size in frames of the created FrameSubscription.
+
+        Returns: the subscriber.
+        """
+        if subscriber is None:
+            subscriber = FrameSubscription(capacity)
+        self._capture_thread.subscribe(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Stop delivering captured frames to a subscriber."""
+        self._capture_thread.unsubscribe(subscriber)
+
+    def create_source(self):
+        """Returns an audio source reading from this hub."""
+        return CaptureHubSource(self)
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+
+    @property
+    def next_frame_index(self):
+        """Index the next captured frame will get."""
+        return self._capture_thread.next_index
+
+    @property
+    def frame_length(self):
+        return self._frame_length
+
+
+class CaptureHubSource(object):
+    """Audio source for ConversationStream backed by a CaptureHub.
+
+    Starting the source subscribes it to the hub and stopping it
+    unsubscribes, so recording a query never opens or closes the device.
+
+    Args:
+      capture_hub: the CaptureHub to read from.
+    """
+
+    def __init__(self, capture_hub):
+        self._capture_hub = capture_hub
+        self._subscription = None
+
+    def read(self, size):
+        """Read bytes from the hub, or silence if the source is stopped."""
+        subscription = self._subscription
+        if subscription is not None:
+            data = subscription.read(size, timeout=1)
+            if data is not None:
+                return data
+        return b'\x00' * size
+
+    def start(self):
+        """Subscribe to the hub, dropping any audio captured before."""
+        if self._subscription is None:
+            self._subscription = self._capture_hub.subscribe()
+
+    def start_at(self, index):
+        """Skip audio captured before frame `index`; the source must be started."""
+        subscription = self._subscription
+        if subscription is not None:
+            subscription.start_at(index)
+
+    def stop(self):
+        """Unsubscribe from the hub."""
+        subscription = self._subscription
+        if subscription is not None:
+            self._subscription = None
+            self._capture_hub.unsubscribe(subscription)
+            subscription.close()
+
+    def close(self):
+        """Stop reading; the device itself is owned by the hub."""
+        self.stop()
+
+    @property
+    def sample_rate(self):
+        return self._capture_hub.sample_rate
@@ -0,0 +1,123 @@
+import numpy as np
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+
+def as_samples(buf):
+    """Returns a read-only int16 view over raw PCM bytes, without copying."""
+    return np.frombuffer(buf, dtype=np.int16)
+
+
+def apply_gain(buf, gain, out=None):
+    """Scales 16-bit PCM by `gain`, saturating instead of wrapping.
+
+    Args:
+      buf: bytes-like object containing 16-bit PCM.
+      gain: linear scale factor.
+      out: optional writable bytes-like object of the same size that
+        receives the result in place of a newly allocated buffer. It may
+        be `buf` itself if `buf` is writable.
+
+    Returns: the scaled PCM as bytes, or `out` if given.
+    """
+    samples = as_samples(buf)
+    scaled = samples * np.float32(gain)
+    np.clip(scaled, INT16_MIN, INT16_MAX, out=scaled)
+    if out is None:
+        return scaled.astype(np.int16).tobytes()
+    np.copyto(np.frombuffer(out, dtype=np.int16), scaled, casting='unsafe')
+    return out
+
+
+def mix(bufs, gains=None):
+    """Mixes several 16-bit PCM buffers into one, saturating on overflow.
+
+    Buffers shorter than the longest one are treated as padded with silence.
+
+    Args:
+      bufs: sequence of bytes-like objects containing 16-bit PCM.
+      gains: optional sequence of linear scale factors, one per buffer.
+
+    Returns: the mixed PCM as bytes.
+    """
+    if gains is None:
+        gains = [1.0] * len(bufs)
+    length = max([len(buf) // 2 for buf in bufs] + [0])
+    mixed = np.zeros(length, dtype=np.float32)
+    for buf, gain in zip(bufs, gains):
+        samples = as_samples(buf)
+        mixed[:len(samples)] += samples * np.float32(gain)
+    np.clip(mixed, INT16_MIN, INT16_MAX, out=mixed)
+    return mixed.astype(np.int16).tobytes()
+
+
+def resample(buf, from_rate, to_rate):
+    """Resamples 16-bit PCM with linear interpolation.
+
+    Args:
+      buf: bytes-like object containing 16-bit PCM.
+      from_rate: sample rate of `buf` in hertz.
+      to_rate: target sample rate in hertz.
+
+    Returns: the resampled PCM as bytes.
+    """
+    if from_rate == to_rate:
+        return bytes(buf)
+    samples = as_samples(buf)
+    if len(samples) == 0:
+        return b''
+    out_length = int(round(len(samples) * float(to_rate) / from_rate))
+    positions = np.arange(out_length, dtype=np.float64) * (
+        float(from_rate) / to_rate)
+    resampled = np.interp(positions, np.arange(len(samples)), samples)
+    return np.round(resampled).astype(np.int16).tobytes()
+
+
+class StreamResampler(object):
+    """Resamples a stream of 16-bit PCM chunks with linear interpolation.
+
+    Unlike `resample`, the interpolation continues across chunk boundaries,
+    so a stream written in small chunks has no discontinuity between them.
+
+    Args:
+      from_rate: sample rate of the written PCM in hertz.
+      to_rate: target sample rate in hertz.
+    """
+
+    def __init__(self, from_rate, to_rate):
+        self._step = float(from_rate) / to_rate
+        self.reset()
+
+    def reset(self):
+        """Start a new stream, e.g. after queued audio was dropped."""
+        self._last = None
+        # Position of the next output sample, relative to the first sample
+        # of the next chunk; -1 is the last sample of the previous chunk.
+        self._position = 0.0
+
+    def process(self, buf):
+        """Returns the resampled PCM of the next chunk as bytes."""
+        samples = as_samples(buf)
+        if len(samples) == 0:
+            return b''
+        if self._last is not None:
+            samples = np.concatenate(([self._last], samples))
+            start = self._position + 1
+        else:
+            start = self._position
+        last_index = len(samples) - 1
+        out_length = int(np.floor((last_index - start) / self._step)) + 1 if start <= last_index else 0
+        positions = start + np.arange(out_length, dtype=np.float64) * self._step
+        resampled = np.interp(positions, np.arange(len(samples)), samples)
+        self._last = samples[-1]
+        self._position = start + out_length * self._step - len(samples)
+        return np.round(resampled).astype(np.int16).tobytes()
+
+
+def rms(buf):
+    """Returns the root mean square amplitude of 16-bit PCM."""
+    samples = as_samples(buf)
+    if len(samples) == 0:
+        return 0.0
+    return float(np.sqrt(np.mean(np.square(samples, dtype=np.float64))))
@@ -0,0 +1,120 @@
+import hashlib
+import io
+import logging
+import os
+from threading import Lock
+
+import sounddevice as sd
+from pydub import AudioSegment
+
+DEFAULT_EARCON_SAMPLE_RATE = 16000
+DEFAULT_EARCON_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'homepi', 'earcons')
+# 10 ms at the default rate, so a sound starts within one short block.
+EARCON_BLOCK_FRAMES = 160
+
+
+class EarconPlayer(object):
+    """Plays short system sounds with no decoding or device setup per use.
+
+    Each sound file is decoded once to 16-bit mono PCM, through pydub, and
+    the result is cached on disk under the SHA-256 of the file contents, so
+    later runs skip the decoder as well. Playback writes the PCM to an
+    output that stays open, an AudioMixer channel or a stream of its own,
+    so a sound starts within one audio block instead of after a subprocess
+    or a new stream was spun up.
+
+    Args:
+      sample_rate: sample rate of the output stream in hertz. Ignored when
+        `output` is given.
+      cache_dir: directory of the decoded PCM cache, None to disable it.
+      device: optional output device index, the default device otherwise.
+      output: optional MixerChannel to play through instead of opening a
+        stream.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_EARCON_SAMPLE_RATE, cache_dir=DEFAULT_EARCON_CACHE_DIR, device=None,
+                 output=None):
+        self._cache_dir = cache_dir
+        self._pcm = dict()
+        self._pcm_lock = Lock()
+        self._play_lock = Lock()
+        self._output = output
+        self._stream = None
+        if (output is not None):
+            self._sample_rate = output.sample_rate
+            return
+        self._sample_rate = sample_rate
+        self._stream = sd.RawOutputStream(
+            samplerate=sample_rate, dtype='int16', channels=1,
+            blocksize=EARCON_BLOCK_FRAMES, latency='low', device=device)
+        self._stream.start()
+
+    def preload(self, paths):
+        """Decode the given sound files ahead of their first use."""
+        for path in paths:
+            if (path is None):
+                continue
+            try:
+                self.load(path)
+            except Exception as e:
+                print('Problem while loading earcon %s: %s' % (path, str(e)))
+
+    def load(self, path):
+        """Returns the PCM of a sound file, decoding it on first use."""
+        with self._pcm_lock:
+            pcm = self._pcm.get(path)
+        if (pcm is None):
+            pcm = self.__load_cached(path)
+            with self._pcm_lock:
+                self._pcm[path] = pcm
+        return pcm
+
+    def __load_cached(self, path):
+        with open(path, 'rb') as sound_file:
+            data = sound_file.read()
+        cache_path = None
+        if (self._cache_dir is not None):
+            cache_path = os.path.join(self._cache_dir, '%s-%d.pcm' % (
+                hashlib.sha256(data).hexdigest(), self._sample_rate))
+            try:
+                with open(cache_path, 'rb') as cache_file:
+                    return cache_file.read()
+            except OSError:
+                pass
+
+        extension = os.path.splitext(path)[1][1:] or None
+        pcm = AudioSegment.from_file(io.BytesIO(data), format=extension).set_channels(
+            1).set_frame_rate(self._sample_rate).set_sample_width(2).raw_data
+        if (cache_path is not None):
+            try:
+                os.makedirs(self._cache_dir, exist_ok=True)
+                temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+                with open(temp_path, 'wb') as cache_file:
+                    cache_file.write(pcm)
+                os.replace(temp_path, cache_path)
+            except OSError as e:
+                logging.warning('Could not cache earcon %s: %s', path, e)
+        return pcm
+
+    def play(self, path):
+        """Play a sound file and return once it was handed to the device."""
+        pcm = self.load(path)
+        with self._play_lock:
+            if (self._output is not None):
+                self._output.write(pcm)
+                self._output.flush()
+            else:
+                self._stream.write(pcm)
+
+    def close(self):
+        """Close the output."""
+        if (self._output is not None):
+            self._output.close()
+        if (self._stream is not None):
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate
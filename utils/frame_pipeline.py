@@ -0,0 +1,305 @@
+import logging
+import math
+from collections import deque
+from ctypes import byref, c_int, c_short, sizeof
+from threading import Condition, Event, Lock, Thread
+
+
+class PorcupineFrameProcessor(object):
+    """Feeds raw PCM frames to Porcupine through one reusable ctypes buffer.
+
+    `Porcupine.process` takes a sequence of ints and rebuilds a ctypes array
+    from it element by element, so the caller has to unpack every frame into
+    a tuple first. Here each raw frame is copied with a single buffer
+    assignment into a preallocated ctypes array, which is handed straight to
+    the native process function when the Porcupine object exposes it.
+
+    That function and the native handle are private attributes of
+    pvporcupine. They are looked up once here; if either is missing, e.g.
+    after a pvporcupine upgrade, frames go through `Porcupine.process`.
+
+    Args:
+      porcupine: Porcupine object returned by `pvporcupine.create`.
+    """
+
+    def __init__(self, porcupine):
+        self._porcupine = porcupine
+        self._frame = (c_short * porcupine.frame_length)()
+        self._frame_size = sizeof(self._frame)
+        self._frame_bytes = memoryview(self._frame).cast('B')
+        self._result = c_int()
+        self._process_func = getattr(porcupine, '_process_func', None)
+        self._handle = getattr(porcupine, '_handle', None)
+        if not callable(self._process_func) or self._handle is None:
+            logging.warning('Porcupine does not expose its native process function, '
+                            'falling back to Porcupine.process')
+            self._process_func = self._handle = None
+
+    def process(self, data):
+        """Processes one frame of raw 16-bit PCM.
+
+        Args:
+          data: bytes or byte memoryview holding exactly `frame_length`
+            samples.
+
+        Returns: index of the detected keyword, or -1.
+        """
+        if len(data) != self._frame_size:
+            raise ValueError('Invalid frame size. Expected %d bytes but received %d' % (
+                self._frame_size, len(data)))
+        self._frame_bytes[:] = data
+        if self._process_func is None:
+            return self._porcupine.process(self._frame)
+        status = self._process_func(
+            self._handle, self._frame, byref(self._result))
+        # pvporcupine maps the native return code onto its status enum.
+        if getattr(status, 'value', status) != 0:
+            raise RuntimeError('Porcupine process failed with status %s' % str(status))
+        return self._result.value
+
+
+class FrameRingBuffer(object):
+    """Bounded FIFO of audio frames between a capture thread and its consumer.
+
+    The producer never blocks: when the buffer is full the oldest frame is
+    discarded and counted, so a slow consumer loses stale audio instead of
+    stalling the device read.
+
+    Args:
+      capacity: maximum number of frames held at once.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('Ring buffer capacity must be positive')
+        self._capacity = capacity
+        self._frames = deque()
+        self._condition = Condition()
+        self._closed = False
+        self.frames_in = 0
+        self.dropped_frames = 0
+        self.overflows = 0
+        self.high_water = 0
+
+    def put(self, frame):
+        """Appends a frame, dropping the oldest one if the buffer is full."""
+        with self._condition:
+            if len(self._frames) >= self._capacity:
+                self._frames.popleft()
+                self.dropped_frames += 1
+            self._frames.append(frame)
+            self.frames_in += 1
+            self.high_water = max(self.high_water, len(self._frames))
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Removes and returns the oldest frame.
+
+        Returns: the frame, or None on timeout or once the buffer is closed
+        and drained.
+        """
+        with self._condition:
+            if not self._frames and not self._closed:
+                self._condition.wait(timeout)
+            if not self._frames:
+                return None
+            return self._frames.popleft()
+
+    def record_overflow(self):
+        """Counts a frame lost by the capture device before it reached us."""
+        with self._condition:
+            self.overflows += 1
+
+    def close(self):
+        """Wakes up the consumer; remaining frames can still be drained."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __len__(self):
+        with self._condition:
+            return len(self._frames)
+
+    def stats(self):
+        """Returns a snapshot of the buffer counters."""
+        with self._condition:
+            return {
+                'capacity': self._capacity,
+                'depth': len(self._frames),
+                'high_water': self.high_water,
+                'frames_in': self.frames_in,
+                'dropped_frames': self.dropped_frames,
+                'overflows': self.overflows,
+            }
+
+
+class FrameSubscription(object):
+    """Per-consumer queue of captured frames that can be read in any size.
+
+    Frames pushed by the capture thread are buffered in a FrameRingBuffer and
+    reassembled on `read`, so consumers with different chunk sizes can share
+    one capture. The capture index of the last frame read is kept in
+    `last_index`.
+
+    Args:
+      capacity: maximum number of frames buffered for this consumer.
+    """
+
+    def __init__(self, capacity):
+        self._ring_buffer = FrameRingBuffer(capacity)
+        self._pending = bytearray()
+        self._start_index = 0
+        self.last_index = None
+
+    def put(self, frame, index):
+        self._ring_buffer.put((index, frame))
+
+    def start_at(self, index):
+        """Skip frames captured before `index`, e.g. because they were read from a PreRollBuffer."""
+        self._start_index = index
+
+    def record_overflow(self):
+        self._ring_buffer.record_overflow()
+
+    def close(self):
+        self._ring_buffer.close()
+
+    @property
+    def closed(self):
+        return self._ring_buffer.closed
+
+    def read(self, size, timeout=None):
+        """Returns exactly `size` bytes of captured audio.
+
+        Returns: the data, or None if it could not be completed before the
+        timeout or the subscription was closed. Partial data is kept for
+        the next read.
+        """
+        while len(self._pending) < size:
+            item = self._ring_buffer.get(timeout)
+            if item is None:
+                return None
+            index, frame = item
+            if index < self._start_index:
+                continue
+            self.last_index = index
+            if not self._pending and len(frame) == size:
+                return frame
+            self._pending += frame
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+    def stats(self):
+        return self._ring_buffer.stats()
+
+
+class PreRollBuffer(object):
+    """Rolling window over the most recent captured frames.
+
+    All audio captured since a frame index (e.g. the frame after a detected
+    hotword) can be read back later, as long as it is still inside the
+    window.
+
+    Args:
+      sample_rate: sample rate of the frames in hertz.
+      frame_length: number of samples per frame.
+      seconds: length of the window in seconds.
+    """
+
+    def __init__(self, sample_rate, frame_length, seconds):
+        self.sample_rate = sample_rate
+        max_frames = max(1, int(math.ceil(seconds * sample_rate / frame_length)))
+        self._frames = deque(maxlen=max_frames)
+        self._lock = Lock()
+
+    def put(self, frame, index):
+        with self._lock:
+            self._frames.append((index, frame))
+
+    def record_overflow(self):
+        pass
+
+    def close(self):
+        pass
+
+    def read_since(self, mark):
+        """Returns the raw PCM captured since frame `mark` that is still buffered.
+
+        Returns: (data, end), where `end` is the index of the first frame not
+        included. A subscription started with `start_at(end)` continues
+        exactly where the data stops.
+        """
+        with self._lock:
+            end = self._frames[-1][0] + 1 if self._frames else mark
+            return b''.join(frame for index, frame in self._frames
+                            if index >= mark), max(end, mark)
+
+
+class FrameCaptureThread(Thread):
+    """Dedicated reader that fans frames from an audio source out to subscribers.
+
+    Subscribers implement `put(frame, index)`, `record_overflow()` and
+    `close()`, like FrameSubscription and PreRollBuffer. `index` counts the
+    captured frames. They can be added and removed while the thread runs,
+    and are closed when capture stops. Every frame is handed to all
+    subscribers under one lock, so a subscriber added at any time receives
+    exactly the frames after those the others already got.
+
+    Args:
+      read_frame: callable returning `(frame, overflowed)`, where `frame` is
+        the raw PCM of one frame or None if it was lost, and `overflowed`
+        tells whether the device reported an input overflow.
+    """
+
+    def __init__(self, read_frame):
+        super(FrameCaptureThread, self).__init__()
+        self.daemon = True
+        self._read_frame = read_frame
+        self._subscribers = ()
+        self._subscribers_lock = Lock()
+        self._stop_event = Event()
+        self._next_index = 0
+
+    @property
+    def next_index(self):
+        """Index the next captured frame will get."""
+        with self._subscribers_lock:
+            return self._next_index
+
+    def subscribe(self, subscriber):
+        with self._subscribers_lock:
+            self._subscribers = self._subscribers + (subscriber,)
+
+    def unsubscribe(self, subscriber):
+        with self._subscribers_lock:
+            self._subscribers = tuple(
+                s for s in self._subscribers if s is not subscriber)
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                frame, overflowed = self._read_frame()
+                # Subscribers only buffer the frame, so holding the lock is cheap.
+                with self._subscribers_lock:
+                    index = self._next_index
+                    if frame is not None:
+                        self._next_index += 1
+                    for subscriber in self._subscribers:
+                        if overflowed:
+                            subscriber.record_overflow()
+                        if frame is not None:
+                            subscriber.put(frame, index)
+        except Exception as e:
+            if not self._stop_event.is_set():
+                print('Audio capture stopped unexpectedly:', str(e))
+        finally:
+            for subscriber in self._subscribers:
+                subscriber.close()
+
+    def stop(self):
+        self._stop_event.set()
@@ -1,13 +1,23 @@
-import struct
-from threading import Thread
+from threading import Event, Thread
+import math
 import pvporcupine
-import pyaudio
-from pydub import AudioSegment
-from pydub.playback import play
+import sounddevice as sd
+from utils import turn_trace
+from utils.capture_hub import CaptureHub
+from utils.earcons import EarconPlayer
+from utils.frame_pipeline import PorcupineFrameProcessor, PreRollBuffer
+
+# Audio captured this long after the earcon was handed to the output still carries its tail and echo.
+EARCON_TAIL_SEC = 0.06
+# Longest wait for the earcon before the query audio starts regardless.
+EARCON_WAIT_SEC = 2
+
+DEFAULT_CAPTURE_BUFFER_FRAMES = 64
+DEFAULT_PRE_ROLL_SECONDS = 2.0
 
 
 class PorcupineInstance(Thread):
-    def __init__(self, library_path, model_path, keyword_paths, sensitivities, input_device_index=None, push_to_talk=None, hotword_detected_file=None, no_internet_audio_file=None):
+    def __init__(self, library_path, model_path, keyword_paths, sensitivities, input_device_index=None, push_to_talk=None, hotword_detected_file=None, no_internet_audio_file=None, capture_buffer_frames=DEFAULT_CAPTURE_BUFFER_FRAMES, pre_roll_seconds=DEFAULT_PRE_ROLL_SECONDS, capture_hub=None, local_commands=None, earcon_player=None):
         """
         Constructor.
         :param library_path: Absolute path to Porcupine's dynamic library.
@@ -17,7 +27,19 @@ class PorcupineInstance(Thread):
         higher sensitivity results in fewer misses at the cost of increasing the false alarm rate. If not set 0.5 will
         be used.
         :param input_device_index: Optional argument. If provided, audio is recorded from this input device. Otherwise,
-        the default audio input device is used.
+        the default audio input device is used. Ignored when `capture_hub` is given.
+        :param capture_buffer_frames: Number of frames buffered for detection before the oldest ones are dropped.
+        :param pre_roll_seconds: Length of the rolling window of recent audio kept by the capture thread. Audio heard
+        after a hotword is sent to the Assistant from this window, so the user does not need to wait for the beep. 0
+        disables it, and the query then starts after the beep.
+        :param capture_hub: Optional CaptureHub shared with the Assistant. If not provided, one is created when the
+        instance runs.
+        :param local_commands: Optional list of keywords handled on the device without the Assistant. Each entry is a
+        dict with the `keyword_path` of a Porcupine model, an optional `sensitivity`, and the device action `command`
+        and optional `params` to run when it is detected, e.g.
+        {"keyword_path": "pause.ppn", "command": "action.devices.commands.mediaPause"}.
+        :param earcon_player: Optional EarconPlayer for the notification sounds. If not provided, one is created when
+        the instance runs.
         """
         super(PorcupineInstance, self).__init__()
         self._library_path = library_path
@@ -28,69 +50,125 @@ class PorcupineInstance(Thread):
         self._push_to_talk = push_to_talk
         self._hotword_detected_file = hotword_detected_file
         self._no_internet_audio_file = no_internet_audio_file
+        self._capture_buffer_frames = capture_buffer_frames
+        self._capture_hub = capture_hub
+        self._subscription = None
+        self._conversation_requested = Event()
+        self._pre_roll_seconds = pre_roll_seconds
+        self._pre_roll = None
+        self._hotword_mark = None
+        self._use_pre_roll = False
+        self._earcon_done = Event()
+        self._earcon_end_index = 0
+        self._local_commands = local_commands or []
+        self._earcon_player = earcon_player
 
     def run(self):
         """
-         Creates an input audio stream, instantiates an instance of Porcupine object, and monitors the audio stream for
+         Subscribes to the capture hub, instantiates an instance of Porcupine object, and monitors the audio stream for
          occurrences of the wake word(s).
+
+         Frames are read by the hub's capture thread and buffered for detection, and conversations run on a separate
+         thread so they never stall the device read.
          """
         porcupine = None
-        pa = None
-        audio_stream = None
+        owns_capture_hub = self._capture_hub is None
+        owns_earcon_player = self._earcon_player is None
         try:
+            if (owns_earcon_player):
+                self._earcon_player = EarconPlayer()
+            self._earcon_player.preload([self._hotword_detected_file, self._no_internet_audio_file])
+
+            # Local command keywords share the Porcupine instance, so they cost no extra pass over the audio.
             porcupine = pvporcupine.create(
                 library_path=self._library_path,
                 model_path=self._model_path,
-                keyword_paths=self._keyword_paths,
-                sensitivities=self._sensitivities)
+                keyword_paths=self._keyword_paths + [c['keyword_path'] for c in self._local_commands],
+                sensitivities=self._sensitivities + [c.get('sensitivity', 0.5) for c in self._local_commands])
 
-            pa = pyaudio.PyAudio()
+            if (owns_capture_hub):
+                self._capture_hub = CaptureHub(
+                    sample_rate=porcupine.sample_rate,
+                    frame_length=porcupine.frame_length,
+                    device=self._input_device_index)
+            if (self._capture_hub.sample_rate != porcupine.sample_rate):
+                raise ValueError('Capture sample rate %d does not match Porcupine sample rate %d' % (
+                    self._capture_hub.sample_rate, porcupine.sample_rate))
 
-            audio_stream = pa.open(
-                rate=porcupine.sample_rate,
-                channels=1,
-                format=pyaudio.paInt16,
-                input=True,
-                frames_per_buffer=porcupine.frame_length,
-                input_device_index=self._input_device_index)
+            frame_length = porcupine.frame_length
+            if (self._pre_roll_seconds > 0):
+                self._pre_roll = self._capture_hub.subscribe(PreRollBuffer(
+                    porcupine.sample_rate, frame_length, self._pre_roll_seconds))
+            self._subscription = self._capture_hub.subscribe(
+                capacity=self._capture_buffer_frames)
+
+            conversation_thread = Thread(target=self.__conversation_loop)
+            conversation_thread.daemon = True
+            conversation_thread.start()
+            self._capture_hub.start()
 
             print('Listening...')
 
+            frame_processor = PorcupineFrameProcessor(porcupine)
+            frame_size = frame_length * 2
+            hotword_count = len(self._keyword_paths)
             while True:
-                pcm = audio_stream.read(porcupine.frame_length)
-                pcm = struct.unpack_from("h" * porcupine.frame_length, pcm)
+                pcm = self._subscription.read(frame_size, timeout=0.5)
+                if pcm is None:
+                    if self._subscription.closed:
+                        break
+                    continue
 
-                result = porcupine.process(pcm)
-                if result >= 0:
-                    self.on_hotword_detected()
+                result = frame_processor.process(pcm)
+                if result >= hotword_count:
+                    self.on_local_command_detected(self._local_commands[result - hotword_count])
+                elif result >= 0:
+                    self.on_hotword_detected(self._subscription.last_index)
 
         except KeyboardInterrupt:
             print('Stopping ...')
         finally:
             if porcupine is not None:
                 porcupine.delete()
-            if audio_stream is not None:
-                audio_stream.close()
-            if pa is not None:
-                pa.terminate()
+            if self._capture_hub is not None:
+                if self._subscription is not None:
+                    self._capture_hub.unsubscribe(self._subscription)
+                if self._pre_roll is not None:
+                    self._capture_hub.unsubscribe(self._pre_roll)
+                if owns_capture_hub:
+                    self._capture_hub.close()
+            if owns_earcon_player and self._earcon_player is not None:
+                self._earcon_player.close()
+            self.__print_capture_stats()
+            self.__print_turn_summary()
+
+    def capture_stats(self):
+        """Returns the frame counters of the detection buffer."""
+        if (self._subscription is None):
+            return dict()
+        return self._subscription.stats()
+
+    def __print_capture_stats(self):
+        print('Capture stats:', ', '.join(
+            '%s=%d' % (k, v) for k, v in sorted(self.capture_stats().items())))
+
+    def __print_turn_summary(self):
+        summary = turn_trace.get_tracer().summary()
+        if (summary):
+            print(turn_trace.format_summary(summary))
 
     @classmethod
     def show_audio_devices(cls):
-        fields = ('index', 'name', 'defaultSampleRate', 'maxInputChannels')
-        pa = pyaudio.PyAudio()
-        for i in range(pa.get_device_count()):
-            info = pa.get_device_info_by_index(i)
+        fields = ('index', 'name', 'default_samplerate', 'max_input_channels')
+        for i, info in enumerate(sd.query_devices()):
+            info = dict(info, index=i)
             print(', '.join("'%s': '%s'" % (k, str(info[k])) for k in fields))
-        pa.terminate()
 
     def __notify_hotword_detected(self):
         if (self._hotword_detected_file is None):
             return
         try:
-            with open(self._hotword_detected_file, 'rb') as detected_audio:
-                response_audio = AudioSegment.from_file(
-                    detected_audio, format='mp3')
-                play(response_audio)
+            self._earcon_player.play(self._hotword_detected_file)
         except Exception as e:
             print('Problem while playing hotword detected audio:', str(e))
 
@@ -98,16 +176,112 @@ class PorcupineInstance(Thread):
         if (self._no_internet_audio_file is None):
             return
         try:
-            with open(self._no_internet_audio_file, 'rb') as no_internet_audio:
-                response_audio = AudioSegment.from_file(
-                    no_internet_audio, format='mp3')
-                play(response_audio)
+            self._earcon_player.play(self._no_internet_audio_file)
         except Exception as e:
             print('Problem while playing no internet notification audio:', str(e))
 
-    def on_hotword_detected(self):
+    def on_hotword_detected(self, frame_index=None):
+        """
+        :param frame_index: Capture index of the frame the hotword was detected in. Audio after it is sent as
+        pre-roll; without it, pre-roll starts at the current capture position.
+        """
         print("Hot word detected!")
-        self.__notify_hotword_detected()
-        if (self._push_to_talk is not None):
-            if (not self._push_to_talk.loop()):
-                self.__notify_no_internet()
+        if (self._conversation_requested.is_set()):
+            print('Conversation in progress, ignoring hot word')
+            return
+        if (self._pre_roll is not None):
+            self._hotword_mark = (frame_index + 1 if frame_index is not None
+                                  else self._capture_hub.next_frame_index)
+        turn_trace.get_tracer().begin_turn(trigger='hotword').mark(turn_trace.HOTWORD_DETECTED)
+        self._conversation_requested.set()
+
+    def on_local_command_detected(self, local_command):
+        command = local_command['command']
+        print('Local command detected: %s' % command)
+        if (self._conversation_requested.is_set()):
+            print('Conversation in progress, ignoring local command')
+            return
+        if (self._push_to_talk is None):
+            return
+        tracer = turn_trace.get_tracer()
+        turn = tracer.begin_turn(trigger='local_command', command=command)
+        turn.mark(turn_trace.LOCAL_COMMAND_DETECTED)
+        try:
+            future = self._push_to_talk.execute_device_command(command, local_command.get('params'))
+        except Exception as e:
+            print('Problem while running local command:', str(e))
+            tracer.end_turn(turn, status='error')
+            return
+        turn.hold()
+        tracer.end_turn(turn, status='ok')
+
+        def on_done(f):
+            turn.mark(turn_trace.DEVICE_ACTIONS_COMPLETED)
+            if (f.exception() is not None):
+                turn.set(status='error')
+            turn.release()
+        future.add_done_callback(on_done)
+
+    def __conversation_loop(self):
+        while True:
+            self._conversation_requested.wait()
+            try:
+                self.__handle_conversation()
+            except Exception as e:
+                print('Problem while handling conversation:', str(e))
+            self._conversation_requested.clear()
+            self.__print_capture_stats()
+
+    def __read_pre_roll(self, source):
+        # Called on the first read of the query.
+        data = b''
+        if (self._use_pre_roll):
+            # Users may speak over the beep, so the query starts right after the hotword.
+            data, start = self._pre_roll.read_since(self._hotword_mark)
+        elif (self._earcon_done.wait(EARCON_WAIT_SEC)):
+            # Without pre-roll users wait for the beep; nothing captured before its end reaches the Assistant.
+            start = self._earcon_end_index
+        else:
+            start = self._capture_hub.next_frame_index
+        # Hub sources subscribed before this read; skip the frames already in the pre-roll or during the earcon.
+        # Other sources cannot skip audio; main.py always reads queries through the hub.
+        start_at = getattr(source, 'start_at', None)
+        if (start_at is not None):
+            start_at(start)
+        return data
+
+    def __play_earcon(self, turn):
+        try:
+            self.__notify_hotword_detected()
+        finally:
+            hub = self._capture_hub
+            self._earcon_end_index = hub.next_frame_index + int(math.ceil(
+                EARCON_TAIL_SEC * hub.sample_rate / hub.frame_length))
+            self._earcon_done.set()
+            if (turn is not None):
+                turn.mark(turn_trace.EARCON_DONE)
+
+    def __handle_conversation(self):
+        turn = turn_trace.get_tracer().current_turn()
+        # The Assist call is opened while the earcon is still playing; without pre-roll, query audio starts after it.
+        self._earcon_done.clear()
+        earcon_thread = Thread(target=self.__play_earcon, args=(turn,))
+        earcon_thread.daemon = True
+        earcon_thread.start()
+        reachable = True
+        try:
+            if (self._push_to_talk is not None):
+                self._use_pre_roll = False
+                if (self._pre_roll is not None):
+                    if (self._pre_roll.sample_rate == self._push_to_talk.sample_rate):
+                        self._use_pre_roll = True
+                    else:
+                        print('Pre-roll disabled: capture rate %d does not match assistant rate %d' % (
+                            self._pre_roll.sample_rate, self._push_to_talk.sample_rate))
+                reachable = self._push_to_talk.loop(self.__read_pre_roll)
+        finally:
+            earcon_thread.join()
+            # Turns are normally ended by the Assistant; this covers conversations that never reached it.
+            turn_trace.get_tracer().end_turn(turn, status='ok' if reachable else 'unreachable')
+        if (not reachable):
+            self.__notify_no_internet()
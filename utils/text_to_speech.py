@@ -1,24 +1,158 @@
 from google.cloud import texttospeech
 from pydub import AudioSegment
 from pydub.playback import play
+from concurrent.futures import ThreadPoolExecutor
+import collections
 import io
+import re
+import wave
+
+from utils.tts_cache import PhraseCache, phrase_key
+
+
+SPEECH_GATE_TIMEOUT_SEC = 30
+# Sample rate of the cached PCM when there is no output channel to match.
+DEFAULT_SPEECH_SAMPLE_RATE = 24000
+# Sentences synthesized ahead of the one playing, or speculatively, see prepare.
+SYNTHESIS_WORKERS = 4
+# Speech is written to the output in slices this long, so an interruption takes effect quickly.
+SPEECH_SLICE_SEC = 0.1
+SENTENCE_END = re.compile(r'(?<=[.!?;])\s+')
+
+# Text and the futures of its synthesized sentences, see TextToSpeechHelper.prepare.
+PreparedSpeech = collections.namedtuple('PreparedSpeech', ['text', 'sentences'])
+
+
+def split_sentences(text):
+    """Returns the sentences of `text`, so long responses can start playing after the first one."""
+    return [sentence for sentence in SENTENCE_END.split(text.strip()) if sentence]
 
 
 class TextToSpeechHelper:
-    def __init__(self, service_account_filename):
-        self.__client = texttospeech.TextToSpeechClient.from_service_account_json(
+    def __init__(self, service_account_filename, speech_gate=None, output=None, cache=None, client=None):
+        """
+        :param speech_gate: Optional callable taking a timeout in seconds and returning True once speech may be played,
+        e.g. PushToTalkInstance.wait_idle, so confirmations never play while a query is recorded.
+        :param output: Optional MixerChannel speech is played through. pydub playback is used otherwise.
+        :param cache: Optional PhraseCache of synthesized phrases, a PhraseCache in the default directory otherwise.
+        :param client: Optional object with the `synthesize_speech` method of TextToSpeechClient, used instead of a
+        client created from the service account file.
+        """
+        self.__client = client or texttospeech.TextToSpeechClient.from_service_account_json(
             service_account_filename)
         self.__voice = texttospeech.VoiceSelectionParams(
             language_code="en-US", ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
         )
+        self.__speech_gate = speech_gate
+        self.__output = output
+        self.__sample_rate = output.sample_rate if output is not None else DEFAULT_SPEECH_SAMPLE_RATE
+        # Raw PCM at the playback rate, so nothing has to be decoded or resampled.
         self.__audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3
+            audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+            sample_rate_hertz=self.__sample_rate
         )
+        self.__cache = cache if cache is not None else PhraseCache()
+        # Device actions run concurrently; synthesis may overlap but playback must not,
+        # so every utterance is played in order by a single worker.
+        self.__synthesis_executor = ThreadPoolExecutor(max_workers=SYNTHESIS_WORKERS)
+        self.__play_executor = ThreadPoolExecutor(max_workers=1)
+        # Incremented by interrupt; playback started before an increment stops.
+        self.__interrupts = 0
 
-    def speak(self, text):
+    def __synthesize(self, text):
+        """Returns 16-bit mono PCM of `text`, from the cache when possible."""
+        key = phrase_key(text, self.__voice, self.__audio_config, self.__sample_rate)
+        pcm = self.__cache.get(key)
+        if (pcm is not None):
+            return pcm
         synthesis_input = texttospeech.SynthesisInput(text=text)
         response = self.__client.synthesize_speech(
             input=synthesis_input, voice=self.__voice, audio_config=self.__audio_config)
-        response_audio = AudioSegment.from_file(
-            io.BytesIO(response.audio_content), format='mp3')
-        play(response_audio)
+        pcm = response.audio_content
+        if (pcm[:4] == b'RIFF'):
+            with wave.open(io.BytesIO(pcm)) as wav:
+                pcm = wav.readframes(wav.getnframes())
+        self.__cache.put(key, pcm)
+        return pcm
+
+    def prewarm(self, phrases):
+        """Synthesize phrases that are not cached yet, e.g. confirmations for the known devices."""
+        for text in phrases:
+            for sentence in split_sentences(text):
+                try:
+                    self.__synthesize(sentence)
+                except Exception as e:
+                    print('Problem while synthesizing "%s": %s' % (sentence, str(e)))
+
+    def prepare(self, text):
+        """Start synthesizing `text` and return a PreparedSpeech for `play`.
+
+        Speech that is prepared but never played still ends up in the cache.
+        """
+        return PreparedSpeech(text, [self.__synthesis_executor.submit(self.__synthesize, sentence)
+                                     for sentence in split_sentences(text)])
+
+    def play(self, prepared):
+        """Play a PreparedSpeech without blocking the caller.
+
+        Returns a Future resolved once the speech was played, or dropped.
+        """
+        return self.__play_executor.submit(self.__play, prepared.text, prepared.sentences)
+
+    def speak(self, text):
+        """Speak `text` without blocking the caller.
+
+        Every sentence is synthesized as soon as possible while the earlier ones play.
+        Returns a Future resolved once the text was played, or dropped.
+        """
+        return self.play(self.prepare(text))
+
+    def interrupt(self):
+        """Stop the speech playing through the output, e.g. when a conversation starts.
+
+        The interrupted sentence is played again from its start once the speech gate opens. Speech played with pydub
+        cannot be interrupted.
+        """
+        self.__interrupts += 1
+        if (self.__output is not None):
+            self.__output.clear()
+
+    def __play(self, text, sentences):
+        # PreparedSpeech has one future per sentence of its text, in order.
+        pending = list(zip(split_sentences(text), sentences))
+        while pending:
+            if (self.__speech_gate is not None and not self.__speech_gate(SPEECH_GATE_TIMEOUT_SEC)):
+                print('Dropping speech, the assistant is still busy: %s' % text)
+                return
+            interrupts = self.__interrupts
+            while pending:
+                sentence, synthesis = pending[0]
+                try:
+                    pcm = synthesis.result()
+                except Exception as e:
+                    print('Problem while synthesizing "%s": %s' % (sentence, str(e)))
+                    return
+                if (self.__output is None):
+                    play(AudioSegment(data=pcm, sample_width=2, frame_rate=self.__sample_rate, channels=1))
+                elif (not self.__write(pcm, interrupts)):
+                    print('Holding speech until the assistant is idle: %s' % sentence)
+                    break
+                pending.pop(0)
+
+    def __write(self, pcm, interrupts):
+        """Play PCM through the output; returns False if interrupt was called meanwhile."""
+        step = int(self.__sample_rate * SPEECH_SLICE_SEC) * 2
+        for offset in range(0, len(pcm), step):
+            if (self.__interrupts != interrupts):
+                break
+            self.__output.write(pcm[offset:offset + step])
+        self.__output.flush()
+        if (self.__interrupts != interrupts):
+            # A slice written while interrupt cleared the output must not play either.
+            self.__output.clear()
+            return False
+        return True
+
+    def close(self):
+        self.__synthesis_executor.shutdown(wait=False)
+        self.__play_executor.shutdown(wait=False)
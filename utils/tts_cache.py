@@ -0,0 +1,124 @@
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+from threading import Lock
+
+DEFAULT_TTS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'homepi', 'tts')
+DEFAULT_TTS_CACHE_MAX_BYTES = 32 * 1024 * 1024
+PCM_EXTENSION = '.pcm'
+
+
+def phrase_key(text, *config):
+    """Returns the cache key of a phrase synthesized with the given config.
+
+    `config` is anything that changes the synthesized audio, e.g. the voice,
+    the audio config and the playback sample rate. Each part is keyed by its
+    string form.
+    """
+    digest = hashlib.sha256()
+    for part in (text,) + config:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class PhraseCache(object):
+    """Size-bounded LRU cache of synthesized phrases as ready-to-play PCM.
+
+    Entries are files named after their key in `cache_dir`, so the cache
+    survives restarts. The least recently used entries, by file
+    modification time, are evicted once the total size goes over
+    `max_bytes`.
+
+    Args:
+      cache_dir: directory of the cached PCM files.
+      max_bytes: total size of the cached files.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_TTS_CACHE_DIR, max_bytes=DEFAULT_TTS_CACHE_MAX_BYTES):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self.__load_index()
+
+    def __path(self, key):
+        return os.path.join(self._cache_dir, key + PCM_EXTENSION)
+
+    def __load_index(self):
+        try:
+            names = [name for name in os.listdir(self._cache_dir) if name.endswith(PCM_EXTENSION)]
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self._cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-len(PCM_EXTENSION)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+        with self._lock:
+            self.__evict()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """Returns the cached PCM of `key`, or None, and marks it recently used."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as pcm_file:
+                pcm = pcm_file.read()
+            os.utime(path)
+            return pcm
+        except OSError:
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+
+    def put(self, key, pcm):
+        """Store the PCM of `key`, evicting old entries over the size bound."""
+        path = self.__path(key)
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            # A temporary file per call, so concurrent puts of a phrase never share one.
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self._cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as pcm_file:
+                    pcm_file.write(pcm)
+                os.replace(temp_path, path)
+            except OSError:
+                os.remove(temp_path)
+                raise
+        except OSError as e:
+            logging.warning('Could not cache synthesized phrase: %s', e)
+            return
+        with self._lock:
+            self._size -= self._entries.pop(key, 0)
+            self._entries[key] = len(pcm)
+            self._size += len(pcm)
+            self.__evict()
+
+    def __evict(self):
+        while self._size > self._max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+
+    @property
+    def size(self):
+        return self._size
@@ -0,0 +1,263 @@
+"""Per-turn latency tracing of the voice pipeline.
+
+Every conversation turn gets a TurnTrace. The hotword detector, the
+Assistant client and the device action handlers record named marks on it,
+each stored as milliseconds since the turn began. Finished turns are kept
+in a ring for summary percentiles and optionally appended, one compact
+JSON object per line, to a size-capped rolling file.
+
+The process-wide tracer is returned by `get_tracer()` and replaced with
+`configure()`. Trace files from several devices can be summarized with:
+
+    $ python -m utils.turn_trace turn_traces.jsonl other_device.jsonl
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+DEFAULT_RING_SIZE = 200
+DEFAULT_MAX_BYTES = 1024 * 1024
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+HOTWORD_DETECTED = 'hotword_detected'
+LOCAL_COMMAND_DETECTED = 'local_command_detected'
+EARCON_DONE = 'earcon_done'
+RECORDING_STARTED = 'recording_started'
+FIRST_REQUEST_SENT = 'first_request_sent'
+END_OF_UTTERANCE = 'end_of_utterance'
+FIRST_AUDIO_OUT = 'first_audio_out'
+DEVICE_COMMAND_STARTED = 'device_command_started'
+DEVICE_COMMAND_DONE = 'device_command_done'
+DEVICE_ACTIONS_COMPLETED = 'device_actions_completed'
+PLAYBACK_FINISHED = 'playback_finished'
+
+
+class TurnTrace(object):
+    """Timing marks and attributes of one conversation turn.
+
+    Marks may be recorded from any thread. Work that outlives the turn,
+    e.g. a background device action, can `hold` it: the turn is then only
+    recorded once every hold was released. Marks recorded after that are
+    dropped.
+    """
+
+    def __init__(self, turn_id, on_end=None, **attributes):
+        self.turn_id = turn_id
+        self.start_time = time.time()
+        self._start = time.monotonic()
+        self._on_end = on_end
+        self._attributes = dict(attributes)
+        self._marks = dict()
+        self._holds = 0
+        self._end_requested = False
+        self._ended = False
+        self._lock = threading.Lock()
+
+    def mark(self, name, overwrite=False):
+        """Record the current time under `name`.
+
+        Only the first mark of a name is kept unless `overwrite` is set.
+        """
+        elapsed_ms = (time.monotonic() - self._start) * 1000
+        with self._lock:
+            if self._ended or (name in self._marks and not overwrite):
+                return
+            self._marks[name] = round(elapsed_ms, 1)
+
+    def set(self, **attributes):
+        """Attach attributes, e.g. the status, to the turn record."""
+        with self._lock:
+            self._attributes.update(attributes)
+
+    def get(self, name, default=None):
+        with self._lock:
+            return self._attributes.get(name, default)
+
+    def hold(self):
+        """Delay recording the turn until a matching `release`."""
+        with self._lock:
+            if not self._ended:
+                self._holds += 1
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+            record = self._finish() if self._end_requested else None
+        if record is not None and self._on_end is not None:
+            self._on_end(record)
+
+    @property
+    def ended(self):
+        return self._ended
+
+    def _end(self, **attributes):
+        """Returns the turn record, or None if it is held or already ended."""
+        with self._lock:
+            if self._ended or self._end_requested:
+                return None
+            self._end_requested = True
+            self._attributes.update(attributes)
+            return self._finish()
+
+    def _finish(self):
+        if self._holds > 0 or self._ended:
+            return None
+        self._ended = True
+        record = dict(self._attributes, turn=self.turn_id,
+                      start=round(self.start_time, 3))
+        record['marks'] = dict(sorted(self._marks.items(),
+                                      key=lambda item: item[1]))
+        return record
+
+
+class TurnTracer(object):
+    """Creates turn traces and collects the finished ones.
+
+    Only one turn is current at a time, since conversations do not
+    overlap; components that run on other threads capture the current
+    turn when their work is submitted.
+
+    Args:
+      path: optional JSONL file receiving every finished turn.
+      max_bytes: size at which the file is rotated to `path + '.1'`.
+      ring_size: number of recent turns kept for summaries.
+    """
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES, ring_size=DEFAULT_RING_SIZE):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._records = deque(maxlen=ring_size)
+        self._ids = itertools.count(1)
+        self._current = None
+        self._lock = threading.Lock()
+
+    def begin_turn(self, **attributes):
+        """Start a new current turn, ending any turn left open."""
+        turn = TurnTrace(next(self._ids), on_end=self._record, **attributes)
+        with self._lock:
+            previous, self._current = self._current, turn
+        if previous is not None:
+            self.end_turn(previous, status='abandoned')
+        return turn
+
+    def current_turn(self):
+        """Returns the current TurnTrace, or None between turns."""
+        return self._current
+
+    def end_turn(self, turn=None, **attributes):
+        """End `turn`, or the current turn, and record it once released.
+
+        Turns that already ended are left untouched.
+        """
+        with self._lock:
+            turn = turn or self._current
+            if turn is None:
+                return
+            if turn is self._current:
+                self._current = None
+        record = turn._end(**attributes)
+        if record is not None:
+            self._record(record)
+
+    def _record(self, record):
+        logging.info('Turn %d: %s', record['turn'], ', '.join(
+            '%s=%.0fms' % item for item in record['marks'].items()))
+        with self._lock:
+            self._records.append(record)
+            if self._path is not None:
+                self._write(record)
+
+    def _write(self, record):
+        try:
+            if (os.path.exists(self._path) and
+                    os.path.getsize(self._path) >= self._max_bytes):
+                os.replace(self._path, self._path + '.1')
+            with open(self._path, 'a') as trace_file:
+                trace_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        except OSError as e:
+            logging.warning('Could not write turn trace: %s', e)
+
+    def records(self):
+        """Returns the recent finished turn records, oldest first."""
+        with self._lock:
+            return list(self._records)
+
+    def summary(self):
+        """Returns percentiles of every mark over the recent turns."""
+        return summarize(self.records())
+
+
+def _percentile(sorted_values, q):
+    index = int(round(q / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(records):
+    """Returns {mark: {'count': n, 'p50': ms, ...}} over turn records."""
+    values = dict()
+    for record in records:
+        for name, elapsed_ms in record.get('marks', {}).items():
+            values.setdefault(name, []).append(elapsed_ms)
+    summary = dict()
+    for name, marks in values.items():
+        marks.sort()
+        summary[name] = dict(count=len(marks), **{
+            'p%d' % q: _percentile(marks, q) for q in SUMMARY_PERCENTILES})
+    return summary
+
+
+def format_summary(summary):
+    """Returns a table of a summary, ordered by median time."""
+    lines = ['%-26s %6s' % ('mark', 'count') + ''.join(
+        ' %9s' % ('p%d ms' % q) for q in SUMMARY_PERCENTILES)]
+    for name, stats in sorted(summary.items(), key=lambda item: item[1]['p50']):
+        lines.append('%-26s %6d' % (name, stats['count']) + ''.join(
+            ' %9.1f' % stats['p%d' % q] for q in SUMMARY_PERCENTILES))
+    return '\n'.join(lines)
+
+
+_tracer = TurnTracer()
+
+
+def get_tracer():
+    """Returns the process-wide TurnTracer."""
+    return _tracer
+
+
+def configure(path=None, max_bytes=DEFAULT_MAX_BYTES, ring_size=DEFAULT_RING_SIZE):
+    """Replace the process-wide TurnTracer, e.g. to write a trace file."""
+    global _tracer
+    _tracer = TurnTracer(path, max_bytes=max_bytes, ring_size=ring_size)
+    return _tracer
+
+
+def mark(name, overwrite=False):
+    """Record a mark on the current turn, if there is one."""
+    turn = _tracer.current_turn()
+    if turn is not None:
+        turn.mark(name, overwrite)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace_files', nargs='+', help='JSONL files written by the turn tracer.')
+    parser.add_argument('--status', help='Only summarize turns with this status, e.g. ok.')
+    args = parser.parse_args()
+    records = []
+    for path in args.trace_files:
+        with open(path) as trace_file:
+            records.extend(json.loads(line) for line in trace_file if line.strip())
+    if args.status is not None:
+        records = [r for r in records if r.get('status') == args.status]
+    print('%d turns' % len(records))
+    print(format_summary(summarize(records)))
+
+
+if __name__ == '__main__':
+    main()